@@ -0,0 +1,337 @@
+"""Benchmark reproducible de la tubería de marcas de agua.
+
+Genera un corpus sintético sin conexión (JPEG/PNG/HEIC de varias resoluciones
+y marcas SVG/PNG con y sin alfa), mide ``load_image``, ``apply_watermark``,
+``save_image`` y ``process_folder`` completo, y guarda los resultados en JSON
+para comparar dos ejecuciones::
+
+    python -m benchmarks.pipeline run -o base.json
+    python -m benchmarks.pipeline run -o nuevo.json --baseline base.json
+    python -m benchmarks.pipeline compare base.json nuevo.json --threshold 0.1
+
+``compare`` (y ``run`` con ``--baseline``) termina con código 1 si algún caso
+es más lento que la referencia en más de ``threshold``, o si falta alguno de
+los casos de la referencia (salvo con ``--allow-missing``).
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import PIL
+from PIL import Image, ImageDraw
+
+from marcasdeagua import lote, nucleo
+from marcasdeagua.formatos import EncodeOptions
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+
+# Resoluciones del corpus (ancho, alto) antes de aplicar ``scale``
+RESOLUTIONS = ((640, 480), (1920, 1080), (4032, 3024))
+
+# Imágenes de cada formato y resolución
+COPIES = 2
+
+_SVG_WATERMARK = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="600" height="200" viewBox="0 0 600 200">
+  <rect x="0" y="0" width="600" height="200" rx="24" fill="#000000" fill-opacity="0.35"/>
+  <circle cx="100" cy="100" r="70" fill="#ffffff" fill-opacity="0.8"/>
+  <rect x="200" y="60" width="360" height="80" fill="#ffffff" fill-opacity="0.6"/>
+</svg>
+"""
+
+
+# Imagen determinista a partir de una semilla: degradado más figuras
+def synthetic_image(size, seed: int, mode: str = "RGB") -> Image.Image:
+    rng = random.Random(seed)
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge(
+        "RGB",
+        (gradient, gradient.rotate(90).resize(size), Image.new("L", size, rng.randrange(256))),
+    )
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(1, width // 3 + 2), y0 + rng.randrange(1, height // 3 + 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+    if mode == "RGBA":
+        alpha = Image.radial_gradient("L").resize(size)
+        image.putalpha(alpha)
+    return image
+
+
+# Codificador HEIC opcional: pyheif solo decodifica, pillow-heif también escribe
+def _heic_writer() -> Optional[Callable[[Image.Image, str], None]]:
+    try:
+        import pillow_heif
+    except ImportError:
+        return None
+    pillow_heif.register_heif_opener()
+    return lambda image, path: image.save(path, "HEIF", quality=85)
+
+
+def build_corpus(corpus_dir: str, seed: int = 0, scale: float = 1.0) -> dict:
+    """Crea (o reutiliza, si coinciden semilla y escala) el corpus en ``corpus_dir``."""
+    stamp_path = os.path.join(corpus_dir, "corpus.json")
+    stamp = {"seed": seed, "scale": scale, "resolutions": RESOLUTIONS, "copies": COPIES}
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            existing = json.load(f)
+        if {k: existing.get(k) for k in stamp} == json.loads(json.dumps(stamp)):
+            return existing
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    inputs_dir = os.path.join(corpus_dir, "inputs")
+    watermarks_dir = os.path.join(corpus_dir, "watermarks")
+    os.makedirs(inputs_dir)
+    os.makedirs(watermarks_dir)
+
+    heic_writer = _heic_writer()
+    formats = ["jpg", "png"] + (["heic"] if heic_writer else [])
+    if not heic_writer:
+        logger.warning("Sin pillow-heif no se pueden generar entradas HEIC: el corpus no las incluye.")
+    inputs: Dict[str, List[str]] = {fmt: [] for fmt in formats}
+    n = seed
+    for width, height in RESOLUTIONS:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        for fmt in formats:
+            for copy in range(COPIES):
+                n += 1
+                image = synthetic_image(size, n)
+                path = os.path.join(inputs_dir, f"{size[0]}x{size[1]}_{copy}.{fmt}")
+                if fmt == "jpg":
+                    image.save(path, "JPEG", quality=90)
+                elif fmt == "png":
+                    image.save(path, "PNG")
+                else:
+                    heic_writer(image, path)
+                inputs[fmt].append(path)
+
+    watermark_size = (max(1, round(600 * scale)), max(1, round(200 * scale)))
+    watermarks = {
+        "png-alpha": os.path.join(watermarks_dir, "alpha.png"),
+        "png-opaque": os.path.join(watermarks_dir, "opaque.png"),
+        "svg": os.path.join(watermarks_dir, "mark.svg"),
+    }
+    synthetic_image(watermark_size, seed + 1000, "RGBA").save(watermarks["png-alpha"])
+    synthetic_image(watermark_size, seed + 1001).save(watermarks["png-opaque"])
+    with open(watermarks["svg"], "w", encoding="utf-8") as f:
+        f.write(_SVG_WATERMARK)
+
+    corpus = dict(stamp, inputs_dir=inputs_dir, inputs=inputs, watermarks=watermarks)
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, indent=2)
+    return corpus
+
+
+# Mediana y mínimo de ``repeat`` ejecuciones (más una de calentamiento)
+def measure(func: Callable[[], object], repeat: int) -> dict:
+    func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {"median": statistics.median(samples), "min": min(samples), "runs": repeat}
+
+
+def _load_watermarks(corpus: dict) -> Dict[str, nucleo.Watermark]:
+    watermarks = {}
+    for name, path in corpus["watermarks"].items():
+        try:
+            watermarks[name] = nucleo.load_watermark(path)
+        except Exception as e:
+            # El SVG necesita svglib y un backend de reportlab
+            logger.warning(f"Se omite la marca {name}: {e}")
+    return watermarks
+
+
+def run_benchmarks(corpus: dict, repeat: int = 5, workers: Optional[int] = None) -> Dict[str, dict]:
+    results: Dict[str, dict] = {}
+    watermarks = _load_watermarks(corpus)
+    encode = EncodeOptions()
+
+    # Funciones sueltas sobre la imagen más grande de cada formato
+    for fmt, paths in corpus["inputs"].items():
+        path = paths[-1]
+        with open(path, "rb") as f:
+            data = f.read()
+        results[f"load_image/{fmt}"] = measure(lambda: nucleo.load_image(path, mode=None, data=data), repeat)
+        # Sobre una imagen de trabajo ya preparada y sin copiarla, como en el
+        # lote: así se mide la composición del rectángulo, no un copy() entero
+        image = nucleo.working_image(nucleo.load_image(path, mode=None, data=data))
+        for name, watermark in watermarks.items():
+            results[f"apply_watermark_in_place/{fmt}/{name}"] = measure(
+                lambda: nucleo.apply_watermark(image, watermark, 10, 10, in_place=True), repeat
+            )
+
+    out_dir = tempfile.mkdtemp(prefix="marcasdeagua-bench-")
+    try:
+        sample = corpus["inputs"]["jpg"][-1]
+        image = nucleo.working_image(nucleo.load_image(sample, mode=None))
+        for out_fmt in ("JPEG", "PNG", "WEBP"):
+            composed = nucleo.Composed(image.convert("RGB"), out_fmt, os.path.join(out_dir, f"save.{out_fmt.lower()}"))
+            results[f"save_image/{out_fmt}"] = measure(lambda: nucleo.save_image(sample, composed, encode), repeat)
+
+        # Lote completo, en serie (tubería) y con procesos
+        worker_counts = sorted({1, workers or os.cpu_count() or 1})
+        for name, path in corpus["watermarks"].items():
+            if name not in watermarks:
+                continue
+            for count in worker_counts:
+                target = os.path.join(out_dir, f"{name}-{count}")
+
+                def batch():
+                    shutil.rmtree(target, ignore_errors=True)
+                    result = lote.process_folder(corpus["inputs_dir"], path, target, 10, 10, workers=count)
+                    if result.failed:
+                        raise RuntimeError(f"{result.failed} imágenes fallaron: {result.errors[0].error}")
+
+                results[f"process_folder/{name}/workers={count}"] = measure(batch, max(1, repeat // 2))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> List[dict]:
+    """Todos los casos de las dos ejecuciones, con la razón actual/referencia de la mediana.
+
+    Un caso que solo está en una de las dos lleva ``None`` en la otra medida y
+    en ``ratio`` (p. ej. HEIC sin pillow-heif, o SVG sin backend de renderPM).
+    """
+    rows = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name, {}).get("median")
+        after = current["results"].get(name, {}).get("median")
+        if before is None or after is None:
+            rows.append({"name": name, "before": before, "after": after, "ratio": None, "regression": False})
+            continue
+        ratio = after / before if before > 0 else float("inf")
+        rows.append({"name": name, "before": before, "after": after, "ratio": ratio, "regression": ratio > 1 + threshold})
+    return rows
+
+
+def print_comparison(rows: List[dict], threshold: float, allow_missing: bool = False) -> bool:
+    """Imprime la comparación; devuelve True si debe fallar (regresión o caso perdido)."""
+    regressions = False
+    missing = []
+    for row in rows:
+        if row["after"] is None:
+            missing.append(row["name"])
+            print(f"{row['name']:<48} {row['before'] * 1000:>10.2f} ms {'—':>13} FALTA")
+            continue
+        if row["before"] is None:
+            print(f"{row['name']:<48} {'—':>13} {row['after'] * 1000:>10.2f} ms          NUEVO")
+            continue
+        mark = "REGRESIÓN" if row["regression"] else ""
+        regressions |= row["regression"]
+        print(
+            f"{row['name']:<48} {row['before'] * 1000:>10.2f} ms {row['after'] * 1000:>10.2f} ms "
+            f"{(row['ratio'] - 1) * 100:>+7.1f}% {mark}"
+        )
+    if regressions:
+        print(f"Hay casos más de un {threshold:.0%} más lentos que la referencia.")
+    if missing:
+        # Una medida que desaparece no es "sin regresión"
+        print(
+            f"ATENCIÓN: faltan {len(missing)} casos de la referencia en la ejecución actual: {', '.join(missing)}",
+            file=sys.stderr,
+        )
+    return regressions or (bool(missing) and not allow_missing)
+
+
+def _load_results(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != RESULTS_VERSION:
+        raise ValueError(f"{path}: versión de resultados no compatible")
+    return data
+
+
+def _run(args: argparse.Namespace) -> int:
+    corpus_dir = args.corpus or os.path.join(tempfile.gettempdir(), "marcasdeagua-bench-corpus")
+    corpus = build_corpus(corpus_dir, args.seed, args.scale)
+    results = run_benchmarks(corpus, args.repeat, args.workers)
+    data = {
+        "version": RESULTS_VERSION,
+        "environment": environment(),
+        "corpus": {"seed": args.seed, "scale": args.scale, "formats": sorted(corpus["inputs"])},
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:<48} {result['median'] * 1000:>10.2f} ms (mín. {result['min'] * 1000:.2f} ms)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+    if args.baseline:
+        rows = compare(_load_results(args.baseline), data, args.threshold)
+        return 1 if print_comparison(rows, args.threshold, args.allow_missing) else 0
+    return 0
+
+
+def _compare(args: argparse.Namespace) -> int:
+    rows = compare(_load_results(args.baseline), _load_results(args.current), args.threshold)
+    return 1 if print_comparison(rows, args.threshold, args.allow_missing) else 0
+
+
+_ALLOW_MISSING_HELP = "solo avisar (sin código 1) si faltan casos de la referencia"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="benchmarks.pipeline", description="Benchmark de la tubería de marcas de agua.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="genera el corpus y mide")
+    run.add_argument("-o", "--output", help="archivo JSON donde guardar los resultados")
+    run.add_argument("--corpus", help="carpeta del corpus (se reutiliza si ya existe con la misma semilla y escala)")
+    run.add_argument("--seed", type=int, default=0, help="semilla del corpus (por defecto: 0)")
+    run.add_argument("--scale", type=float, default=1.0, help="factor sobre las resoluciones del corpus (por defecto: 1)")
+    run.add_argument("--repeat", type=int, default=5, help="repeticiones por caso (por defecto: 5)")
+    run.add_argument("-j", "--workers", type=int, default=None, help="procesos para el lote en paralelo")
+    run.add_argument("--baseline", help="resultados de referencia con los que comparar")
+    run.add_argument("--threshold", type=float, default=0.1, help="empeoramiento tolerado (por defecto: 0.1 = 10%%)")
+    run.add_argument("--allow-missing", action="store_true", help=_ALLOW_MISSING_HELP)
+    run.set_defaults(func=_run)
+
+    comp = subparsers.add_parser("compare", help="compara dos archivos de resultados")
+    comp.add_argument("baseline")
+    comp.add_argument("current")
+    comp.add_argument("--threshold", type=float, default=0.1, help="empeoramiento tolerado (por defecto: 0.1 = 10%%)")
+    comp.add_argument("--allow-missing", action="store_true", help=_ALLOW_MISSING_HELP)
+    comp.set_defaults(func=_compare)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
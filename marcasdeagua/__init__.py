@@ -0,0 +1,40 @@
+"""Núcleo para poner marcas de agua a carpetas o archivos, sin interfaz gráfica.
+
+La interfaz Flet vive en ``marcasdeagua.marca`` y solo se importa al abrirla.
+"""
+
+from marcasdeagua.escaneo import scan_images
+from marcasdeagua.formatos import SUPPORTED_EXTENSIONS, EncodeOptions
+from marcasdeagua.lote import BatchResult, Progress, process_folder
+from marcasdeagua.metricas import RunReport, Timer
+from marcasdeagua.nucleo import (
+    FileResult,
+    TileOptions,
+    Watermark,
+    apply_watermark,
+    iter_images,
+    load_base64_image,
+    load_image,
+    load_watermark,
+    process_image,
+)
+
+__all__ = [
+    "SUPPORTED_EXTENSIONS",
+    "BatchResult",
+    "EncodeOptions",
+    "FileResult",
+    "Progress",
+    "RunReport",
+    "TileOptions",
+    "Timer",
+    "Watermark",
+    "apply_watermark",
+    "iter_images",
+    "load_base64_image",
+    "load_image",
+    "load_watermark",
+    "process_folder",
+    "process_image",
+    "scan_images",
+]
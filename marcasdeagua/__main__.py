@@ -0,0 +1,5 @@
+import sys
+
+from marcasdeagua.cli import main
+
+sys.exit(main())
@@ -0,0 +1,146 @@
+import io
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+from typing import IO, Callable, Iterator, Optional, Sequence, Tuple
+
+from marcasdeagua import escaneo, formatos
+from marcasdeagua.nucleo import write_file
+
+# Extensiones de salida y el modo de tarfile (en flujo) que les corresponde
+_TAR_MODES = {
+    ".tar": "w|",
+    ".tar.gz": "w|gz",
+    ".tgz": "w|gz",
+    ".tar.bz2": "w|bz2",
+    ".tar.xz": "w|xz",
+}
+
+
+def archive_kind(path: str) -> str:
+    """``"zip"``, ``"tar"`` o ``""`` según la extensión de ``path``."""
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        return "zip"
+    if lower.endswith(tuple(_TAR_MODES)):
+        return "tar"
+    return ""
+
+
+# Una entrada es archivo comprimido si es un archivo (no carpeta) zip o tar
+def is_archive(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+# Nombre seguro dentro de la salida: sin rutas absolutas ni ".."
+def safe_name(name: str) -> str:
+    name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if name in ("", ".") or name == ".." or name.startswith("../"):
+        raise ValueError(f"Ruta no permitida dentro del archivo: {name}")
+    return name
+
+
+# Bytes de una entrada si es imagen, o None. Por extensión no se lee nada; con
+# ``sniff`` solo la cabecera, y el resto únicamente si resulta ser una imagen
+def _entry_data(name: str, open_entry: Callable[[], IO[bytes]], sniff: bool) -> Optional[bytes]:
+    known = escaneo.is_image(name, b"")
+    if not known and not sniff:
+        return None
+    with open_entry() as f:
+        head = b"" if known else f.read(formatos.SNIFF_BYTES)
+        if not known and not escaneo.is_image(name, head, sniff):
+            return None
+        return head + f.read()
+
+
+def iter_entries(
+    source: str, include: Sequence[str] = (), exclude: Sequence[str] = (), sniff: bool = False
+) -> Iterator[Tuple[str, bytes]]:
+    """Entrega ``(ruta relativa con "/", bytes)`` de cada imagen de ``source``.
+
+    ``source`` puede ser una carpeta, un zip o un tar (comprimido o no). Los
+    tar se leen como flujo, entrada a entrada, sin saltar hacia atrás; nada se
+    extrae a disco. Los filtros son los mismos que en ``scan_images``, y las
+    entradas que no son imágenes se descartan sin cargarlas en memoria.
+    """
+    if os.path.isdir(source):
+        for input_path in escaneo.scan_images(source, include, exclude, sniff):
+            with open(input_path, "rb") as f:
+                yield os.path.relpath(input_path, source).replace(os.sep, "/"), f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not escaneo.matches_filters(info.filename, include, exclude):
+                    continue
+                data = _entry_data(info.filename, lambda: archive.open(info), sniff)
+                if data is not None:
+                    yield info.filename, data
+    else:
+        with tarfile.open(source, "r|*") as archive:
+            for member in archive:
+                if not member.isfile() or not escaneo.matches_filters(member.name, include, exclude):
+                    continue
+                data = _entry_data(member.name, lambda: archive.extractfile(member), sniff)
+                if data is not None:
+                    yield member.name, data
+
+
+class EntryWriter:
+    """Destino de las imágenes procesadas: carpeta, zip o tar.
+
+    En un zip las imágenes se guardan sin comprimir (ya lo están); un tar se
+    escribe en flujo y se comprime según su extensión. Mientras se escribe,
+    el archivo se llama ``<destino>.part`` y se renombra al cerrar, igual que
+    las imágenes sueltas. Se puede usar desde varios hilos.
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self.kind = archive_kind(target)
+        self._lock = threading.Lock()
+        self._tmp_path = target + ".part"
+        self._archive = None
+        if self.kind:
+            os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+            if self.kind == "zip":
+                self._archive = zipfile.ZipFile(self._tmp_path, "w", zipfile.ZIP_STORED)
+            else:
+                mode = next(m for ext, m in _TAR_MODES.items() if target.lower().endswith(ext))
+                self._archive = tarfile.open(self._tmp_path, mode)
+
+    def write(self, name: str, data: bytes) -> str:
+        name = safe_name(name)
+        if not self.kind:
+            output_path = os.path.join(self.target, *name.split("/"))
+            write_file(output_path, data)
+            return output_path
+        with self._lock:
+            if self.kind == "zip":
+                self._archive.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self._archive.addfile(info, io.BytesIO(data))
+        return f"{self.target}:{name}"
+
+    def close(self, keep: bool = True) -> None:
+        if self._archive is None:
+            return
+        self._archive.close()
+        self._archive = None
+        if keep:
+            os.replace(self._tmp_path, self.target)
+        else:
+            os.remove(self._tmp_path)
+
+    def __enter__(self) -> "EntryWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(keep=exc_type is None)
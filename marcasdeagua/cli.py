@@ -0,0 +1,302 @@
+import argparse
+import logging
+import sys
+from typing import List, Optional
+
+# Solo importamos lo imprescindible aquí: Flet y los backends de formatos se
+# cargan cuando de verdad hacen falta.
+
+
+# Codificación y mosaico a partir de los argumentos comunes a run y enqueue
+def _job_options(args: argparse.Namespace):
+    from marcasdeagua.formatos import EncodeOptions
+    from marcasdeagua.nucleo import TileOptions
+
+    encode = EncodeOptions(
+        format=args.format,
+        quality=args.quality,
+        compress_level=args.png_compress_level,
+        webp_method=args.webp_method,
+        progressive=args.progressive,
+        optimize=args.optimize,
+        keep_exif=not args.strip_exif,
+        keep_icc=not args.strip_icc,
+    )
+    tile = None
+    if args.tile:
+        tile = TileOptions(args.tile_opacity, args.tile_size, args.tile_spacing, args.tile_angle)
+    return encode, tile
+
+
+def _run(args: argparse.Namespace) -> int:
+    from marcasdeagua import lote
+
+    try:
+        encode, tile = _job_options(args)
+    except ValueError as e:
+        print(f"Parámetros inválidos: {e}", file=sys.stderr)
+        return 1
+    try:
+        result = lote.process_folder(
+            args.input,
+            args.watermark,
+            args.output,
+            args.x,
+            args.y,
+            workers=args.workers,
+            watermark_cache_size=args.watermark_cache,
+            encode=encode,
+            incremental=args.incremental,
+            include=args.include,
+            exclude=args.exclude,
+            sniff=args.sniff,
+            memory_budget=args.memory_budget << 20 if args.memory_budget else None,
+            tile=tile,
+            dedup=args.dedup,
+        )
+    except Exception as e:
+        print(f"No se pudo procesar el lote: {e}", file=sys.stderr)
+        return 1
+    for failure in result.errors:
+        print(f"FALLO {failure.input_path}: {failure.error}", file=sys.stderr)
+    print(f"Procesadas {result.processed} imágenes. Fallidas: {result.failed}. Sin cambios: {result.skipped}.")
+    if args.dedup:
+        print(f"Duplicados: {result.duplicates} (ahorro estimado: {result.dedup_seconds_saved:.1f} s de proceso).")
+    print(f"Memoria máxima: {lote.memory_summary(result)}.")
+    try:
+        if args.report:
+            result.report.write_json(args.report)
+        if args.prometheus:
+            result.report.write_prometheus(args.prometheus)
+    except OSError as e:
+        print(f"No se pudo escribir el informe: {e}", file=sys.stderr)
+        return 1
+    return 0 if result.failed == 0 else 1
+
+
+def _serve(args: argparse.Namespace) -> int:
+    from marcasdeagua.servicio import WatermarkService, parse_watermark_spec
+
+    try:
+        service = WatermarkService(
+            dict(parse_watermark_spec(spec) for spec in args.watermark),
+            workers=args.workers,
+            watermark_cache_size=args.watermark_cache,
+            max_body=args.max_body << 20,
+        )
+    except Exception as e:
+        print(f"Error al cargar las marcas de agua: {e}", file=sys.stderr)
+        return 1
+    print(f"Escuchando en http://{args.host}:{args.port} (marcas: {', '.join(service.watermarks)})")
+    try:
+        service.serve_forever(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _enqueue(args: argparse.Namespace) -> int:
+    from marcasdeagua import cola
+
+    try:
+        encode, tile = _job_options(args)
+        added = cola.enqueue(
+            args.queue,
+            args.input,
+            args.watermark,
+            args.output,
+            args.x,
+            args.y,
+            encode,
+            tile,
+            include=args.include,
+            exclude=args.exclude,
+            sniff=args.sniff,
+        )
+    except Exception as e:
+        print(f"No se pudo encolar: {e}", file=sys.stderr)
+        return 1
+    print(f"Encoladas {added} imágenes nuevas.")
+    return 0
+
+
+def _work(args: argparse.Namespace) -> int:
+    from concurrent.futures import ProcessPoolExecutor
+
+    from marcasdeagua import cola
+
+    options = dict(batch_size=args.batch, lease=args.lease, poll_interval=args.poll)
+    try:
+        if args.workers <= 1:
+            results = [cola.work(args.queue, args.worker_id, **options)]
+        else:
+            # Cada proceso es un trabajador independiente con su propio identificador
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [executor.submit(cola.work, args.queue, None, **options) for _ in range(args.workers)]
+                results = [future.result() for future in futures]
+    except Exception as e:
+        print(f"Error en el trabajador: {e}", file=sys.stderr)
+        return 1
+    processed = sum(done for done, _ in results)
+    failed = sum(failures for _, failures in results)
+    print(f"Procesadas {processed} imágenes. Fallidas: {failed}.")
+    return 0 if failed == 0 else 1
+
+
+def _status(args: argparse.Namespace) -> int:
+    from marcasdeagua import cola
+
+    with cola.WorkQueue(args.queue) as queue:
+        counts = queue.counts()
+        print(
+            f"Pendientes: {counts['pending']}. En curso: {counts['leased']} ({counts['expired']} vencidas). "
+            f"Hechas: {counts['done']}. Fallidas: {counts['failed']}."
+        )
+        for path, error in queue.failures():
+            print(f"FALLO {path}: {error}", file=sys.stderr)
+        if args.retry_failed:
+            print(f"Devueltas a la cola {queue.requeue_failed()} imágenes fallidas.")
+    return 0
+
+
+def _add_job_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-x", type=int, default=10, help="coordenada X (por defecto: 10)")
+    parser.add_argument("-y", type=int, default=10, help="coordenada Y (por defecto: 10)")
+    parser.add_argument(
+        "--include", action="append", default=[], metavar="GLOB", help="solo procesa rutas que cumplan el patrón (repetible)"
+    )
+    parser.add_argument(
+        "--exclude", action="append", default=[], metavar="GLOB", help="ignora rutas o carpetas que cumplan el patrón (repetible)"
+    )
+    parser.add_argument(
+        "--sniff", action="store_true", help="identifica por contenido los archivos sin extensión de imagen conocida"
+    )
+    tiling = parser.add_argument_group("mosaico")
+    tiling.add_argument("--tile", action="store_true", help="repite la marca en mosaico sobre toda la imagen (ignora -x/-y)")
+    tiling.add_argument("--tile-opacity", type=float, default=0.3, help="opacidad de la marca, 0-1 (por defecto: 0.3)")
+    tiling.add_argument(
+        "--tile-size", type=float, default=0.25, help="tamaño máximo de cada marca respecto a la imagen (por defecto: 0.25)"
+    )
+    tiling.add_argument("--tile-spacing", type=int, default=100, help="píxeles entre marcas (por defecto: 100)")
+    tiling.add_argument("--tile-angle", type=float, default=30.0, help="giro del mosaico en grados (por defecto: 30)")
+    output = parser.add_argument_group("codificación de salida")
+    output.add_argument(
+        "-f",
+        "--format",
+        choices=["original", "jpeg", "webp", "png"],
+        default="original",
+        help="formato de salida (por defecto: el de cada imagen; HEIC pasa a JPEG)",
+    )
+    output.add_argument("-q", "--quality", type=int, default=90, help="calidad JPEG/WebP, 1-100 (por defecto: 90)")
+    output.add_argument(
+        "--png-compress-level", type=int, default=6, choices=range(10), metavar="0-9", help="compresión PNG (por defecto: 6)"
+    )
+    output.add_argument(
+        "--webp-method", type=int, default=4, choices=range(7), metavar="0-6", help="esfuerzo del codificador WebP (por defecto: 4)"
+    )
+    output.add_argument("--progressive", action="store_true", help="JPEG progresivo")
+    output.add_argument("--optimize", action="store_true", help="optimiza JPEG/PNG (más lento, archivos más pequeños)")
+    output.add_argument("--strip-exif", action="store_true", help="no copia los metadatos EXIF")
+    output.add_argument("--strip-icc", action="store_true", help="no copia el perfil de color ICC")
+
+
+def _gui(args: argparse.Namespace) -> int:
+    import flet as ft
+    from marcasdeagua.marca import main as gui_main
+
+    ft.app(target=gui_main, assets_dir="assets")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="marcasdeagua", description="Pone marcas de agua a carpetas de imágenes.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="muestra una línea por cada imagen guardada")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="procesa una carpeta sin interfaz gráfica")
+    run.add_argument("input", help="carpeta con las imágenes")
+    run.add_argument("watermark", help="archivo de la marca de agua (SVG/PNG/JPG/HEIC)")
+    run.add_argument("output", help="carpeta de salida")
+    run.add_argument("-j", "--workers", type=int, default=None, help="procesos en paralelo (por defecto: todos los núcleos)")
+    run.add_argument(
+        "--incremental",
+        action="store_true",
+        help="solo procesa lo nuevo o cambiado desde la última ejecución (manifiesto en la carpeta de salida)",
+    )
+    run.add_argument(
+        "--dedup",
+        choices=["copy", "link"],
+        default=None,
+        help="procesa una vez las imágenes repetidas y copia (o enlaza) su salida al resto",
+    )
+    run.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="memoria máxima estimada para las imágenes en curso; las que no caben esperan",
+    )
+    run.add_argument(
+        "--watermark-cache", type=int, default=32, help="tamaños de marca de agua en caché por proceso (por defecto: 32)"
+    )
+    run.add_argument("--report", metavar="JSON", help="guarda un informe con tiempos por etapa, bytes y rendimiento por formato")
+    run.add_argument(
+        "--prometheus", metavar="ARCHIVO", help="guarda las mismas métricas en formato de texto de Prometheus"
+    )
+    _add_job_arguments(run)
+    run.set_defaults(func=_run)
+
+    serve = subparsers.add_parser("serve", help="servicio HTTP local que pone la marca a las imágenes recibidas")
+    serve.add_argument(
+        "-w",
+        "--watermark",
+        action="append",
+        required=True,
+        metavar="[NOMBRE=]RUTA",
+        help="marca de agua a precargar (repetible; la primera es la predeterminada)",
+    )
+    serve.add_argument("--host", default="127.0.0.1", help="dirección de escucha (por defecto: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8080, help="puerto (por defecto: 8080)")
+    serve.add_argument("-j", "--workers", type=int, default=None, help="procesos de trabajo (por defecto: todos los núcleos)")
+    serve.add_argument("--max-body", type=int, default=64, metavar="MB", help="tamaño máximo de una petición (por defecto: 64)")
+    serve.add_argument(
+        "--watermark-cache", type=int, default=32, help="tamaños de marca de agua en caché por proceso (por defecto: 32)"
+    )
+    serve.set_defaults(func=_serve)
+
+    enqueue = subparsers.add_parser("enqueue", help="encola una carpeta para procesarla entre varias máquinas")
+    enqueue.add_argument("queue", help="base de datos SQLite de la cola (en un disco compartido)")
+    enqueue.add_argument("input", help="carpeta con las imágenes (misma ruta en todas las máquinas)")
+    enqueue.add_argument("watermark", help="archivo de la marca de agua (SVG/PNG/JPG/HEIC)")
+    enqueue.add_argument("output", help="carpeta de salida")
+    _add_job_arguments(enqueue)
+    enqueue.set_defaults(func=_enqueue)
+
+    work = subparsers.add_parser("work", help="procesa imágenes de una cola hasta vaciarla")
+    work.add_argument("queue", help="base de datos SQLite de la cola")
+    work.add_argument("-j", "--workers", type=int, default=1, help="trabajadores en esta máquina (por defecto: 1)")
+    work.add_argument("--batch", type=int, default=8, help="imágenes que se reclaman de una vez (por defecto: 8)")
+    work.add_argument(
+        "--lease", type=float, default=300, help="segundos antes de que otro trabajador pueda reclamarlas (por defecto: 300)"
+    )
+    work.add_argument("--poll", type=float, default=5, help="segundos de espera cuando todo está reclamado (por defecto: 5)")
+    work.add_argument("--worker-id", default=None, help="identificador del trabajador (por defecto: máquina:pid:aleatorio)")
+    work.set_defaults(func=_work)
+
+    status = subparsers.add_parser("status", help="estado de una cola")
+    status.add_argument("queue", help="base de datos SQLite de la cola")
+    status.add_argument("--retry-failed", action="store_true", help="devuelve las fallidas a la cola")
+    status.set_defaults(func=_status)
+
+    gui = subparsers.add_parser("gui", help="abre la interfaz gráfica")
+    gui.set_defaults(func=_gui)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    return args.func(args)
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from dataclasses import asdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from marcasdeagua import escaneo
+from marcasdeagua.formatos import EncodeOptions
+from marcasdeagua.nucleo import TileOptions, load_watermark, process_image
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_until);
+"""
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class WorkQueue:
+    """Cola de trabajo en SQLite con arrendamientos, para repartir un lote entre máquinas.
+
+    Cada trabajador reclama un grupo de rutas durante ``lease`` segundos y las
+    marca como hechas o fallidas al terminar. Si un trabajador muere, sus
+    rutas vuelven a estar disponibles cuando vence el arrendamiento; tras
+    ``max_attempts`` intentos una ruta se da por fallida. La base puede estar
+    en un disco compartido: se usa el diario clásico (no WAL, que necesita
+    memoria compartida entre procesos) y transacciones ``BEGIN IMMEDIATE``
+    para que dos trabajadores no reclamen lo mismo. Los vencimientos usan el
+    reloj de cada máquina, que deben estar sincronizados.
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 3, timeout: float = 60.0):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "WorkQueue":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def set_config(self, params: dict) -> None:
+        stored = self.config()
+        if stored is not None and stored != json.loads(json.dumps(params)):
+            raise ValueError("La cola ya tiene otro lote con otros parámetros")
+        self.conn.execute("INSERT OR IGNORE INTO config (id, params) VALUES (1, ?)", (json.dumps(params, sort_keys=True),))
+
+    def config(self) -> Optional[dict]:
+        row = self.conn.execute("SELECT params FROM config WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, rel_paths, chunk_size: int = 500) -> int:
+        """Encola rutas relativas (las ya encoladas se ignoran); devuelve cuántas son nuevas."""
+        added = 0
+        chunk: List[Tuple[str, float]] = []
+
+        def flush() -> int:
+            conn = self._transaction()
+            try:
+                cursor = conn.executemany("INSERT OR IGNORE INTO items (path, updated) VALUES (?, ?)", chunk)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            chunk.clear()
+            return cursor.rowcount
+
+        for rel_path in rel_paths:
+            chunk.append((rel_path, time.time()))
+            if len(chunk) >= chunk_size:
+                added += flush()
+        if chunk:
+            added += flush()
+        return added
+
+    def claim(self, worker: str, count: int, lease: float) -> List[Tuple[int, str]]:
+        """Reclama hasta ``count`` rutas libres o con el arrendamiento vencido."""
+        now = time.time()
+        conn = self._transaction()
+        try:
+            # Lo que venció demasiadas veces ya no se reparte
+            conn.execute(
+                "UPDATE items SET state = 'failed', error = 'Demasiados intentos', updated = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            rows = conn.execute(
+                "SELECT id, path FROM items WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?",
+                [(worker, now + lease, now, item_id) for item_id, _ in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def renew(self, worker: str, ids: Sequence[int], lease: float) -> None:
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE items SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            [(now + lease, now, item_id, worker) for item_id in ids],
+        )
+
+    def finish(self, worker: str, item_id: int, ok: bool, error: Optional[str] = None) -> bool:
+        """Marca una ruta; si el arrendamiento ya pasó a otro trabajador no toca nada."""
+        cursor = self.conn.execute(
+            "UPDATE items SET state = ?, error = ?, lease_until = NULL, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            ("done" if ok else "failed", error, time.time(), item_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+        counts["expired"] = self.conn.execute(
+            "SELECT COUNT(*) FROM items WHERE state = 'leased' AND lease_until < ?", (time.time(),)
+        ).fetchone()[0]
+        return counts
+
+    def failures(self, limit: int = 100) -> List[Tuple[str, str]]:
+        return self.conn.execute(
+            "SELECT path, error FROM items WHERE state = 'failed' ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def requeue_failed(self) -> int:
+        cursor = self.conn.execute(
+            "UPDATE items SET state = 'pending', attempts = 0, error = NULL, worker = NULL, updated = ? "
+            "WHERE state = 'failed'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+
+# Parámetros del lote tal como se guardan en la cola (rutas absolutas)
+def job_params(
+    input_dir: str,
+    watermark_path: str,
+    output_dir: str,
+    x: int,
+    y: int,
+    encode: Optional[EncodeOptions] = None,
+    tile: Optional[TileOptions] = None,
+) -> dict:
+    return {
+        "input_dir": os.path.abspath(input_dir),
+        "watermark_path": os.path.abspath(watermark_path),
+        "output_dir": os.path.abspath(output_dir),
+        "x": x,
+        "y": y,
+        "encode": asdict(encode or EncodeOptions()),
+        "tile": asdict(tile) if tile else None,
+    }
+
+
+def enqueue(
+    db_path: str,
+    input_dir: str,
+    watermark_path: str,
+    output_dir: str,
+    x: int,
+    y: int,
+    encode: Optional[EncodeOptions] = None,
+    tile: Optional[TileOptions] = None,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    sniff: bool = False,
+) -> int:
+    """Recorre ``input_dir`` y encola sus imágenes; devuelve cuántas son nuevas.
+
+    Se puede repetir sobre la misma cola para añadir lo que haya aparecido,
+    siempre con los mismos parámetros.
+    """
+    # Validamos la marca de agua aquí para no encolar un lote que no puede salir bien
+    load_watermark(watermark_path, cache_size=0)
+    params = job_params(input_dir, watermark_path, output_dir, x, y, encode, tile)
+    with WorkQueue(db_path) as queue:
+        queue.set_config(params)
+        rel_paths = (
+            os.path.relpath(path, input_dir).replace(os.sep, "/")
+            for path in escaneo.scan_images(input_dir, include, exclude, sniff)
+        )
+        added = queue.add(rel_paths)
+    logger.info("Encoladas %d imágenes nuevas en %s", added, db_path)
+    return added
+
+
+def work(
+    db_path: str,
+    worker: Optional[str] = None,
+    batch_size: int = 8,
+    lease: float = 300.0,
+    poll_interval: float = 5.0,
+    watermark_cache_size: int = 32,
+) -> Tuple[int, int]:
+    """Reclama grupos de la cola y los procesa hasta que no quede nada.
+
+    Usa la misma carga, composición y guardado que ``process_image``. Tras
+    cada imagen se renueva el arrendamiento del resto del grupo. Si solo
+    quedan rutas reclamadas por otros, espera por si alguna vence. Devuelve
+    ``(procesadas, fallidas)`` por este trabajador.
+    """
+    worker = worker or default_worker_id()
+    processed = failed = 0
+    with WorkQueue(db_path) as queue:
+        params = queue.config()
+        if params is None:
+            raise ValueError(f"La cola {db_path} está vacía: usa primero 'enqueue'")
+        tile = TileOptions(**params["tile"]) if params.get("tile") else None
+        encode = EncodeOptions(**params["encode"])
+        watermark = load_watermark(params["watermark_path"], watermark_cache_size, tile)
+        input_dir, output_dir = params["input_dir"], params["output_dir"]
+        while True:
+            items = queue.claim(worker, batch_size, lease)
+            if not items:
+                counts = queue.counts()
+                if counts["pending"] == 0 and counts["leased"] == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+            for index, (item_id, rel_path) in enumerate(items):
+                input_path = os.path.join(input_dir, *rel_path.split("/"))
+                result = process_image(input_path, watermark, input_dir, output_dir, params["x"], params["y"], encode)
+                if not queue.finish(worker, item_id, result.ok, result.error):
+                    logger.warning("El arrendamiento de %s venció y lo tiene otro trabajador", rel_path)
+                elif result.ok:
+                    processed += 1
+                else:
+                    failed += 1
+                queue.renew(worker, [other for other, _ in items[index + 1 :]], lease)
+    logger.info("Trabajador %s: %d procesadas, %d fallidas", worker, processed, failed)
+    return processed, failed
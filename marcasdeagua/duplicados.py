@@ -0,0 +1,158 @@
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from marcasdeagua import formatos
+from marcasdeagua.manifiesto import file_digest
+from marcasdeagua.nucleo import FileResult
+
+logger = logging.getLogger(__name__)
+
+DEDUP_MODES = ("copy", "link")
+
+
+# Copia de una entrada ya vista, pendiente de recibir la salida de su original
+class Duplicate(NamedTuple):
+    input_path: str
+    st: os.stat_result
+    digest: str
+
+
+class Deduplicator:
+    """Procesa una sola vez las entradas con el mismo contenido.
+
+    Solo se calcula el hash de los archivos cuyo tamaño ya apareció antes
+    (y, la primera vez, del original con ese tamaño): en un árbol sin
+    duplicados casi nada se lee dos veces. Las copias no se procesan; cuando
+    su original termina, su salida se copia (``mode="copy"``) o se enlaza
+    (``"link"``, con copia si el sistema no lo permite) en el sitio que les
+    corresponde.
+    """
+
+    def __init__(self, input_dir: str, output_dir: str, mode: str = "copy"):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Modo de duplicados no soportado: {mode}")
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.mode = mode
+        # Copias encontradas al recorrer y copias ya materializadas
+        self.found = 0
+        self.duplicates = 0
+        self.seconds_saved = 0.0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        # Originales por tamaño; su hash se calcula al aparecer otro igual de grande
+        self._by_size: Dict[int, List[str]] = {}
+        self._digests: Dict[str, str] = {}
+        self._by_digest: Dict[str, str] = {}
+        self._waiting: Dict[str, List[Duplicate]] = {}
+        self._done: Dict[str, FileResult] = {}
+
+    def _digest(self, input_path: str) -> str:
+        digest = self._digests.get(input_path)
+        if digest is None:
+            digest = self._digests[input_path] = file_digest(input_path)
+            self._by_digest.setdefault(digest, input_path)
+        return digest
+
+    # Original del que ``input_path`` es copia, o None si es nuevo
+    def _original(self, input_path: str, size: int) -> Optional[str]:
+        same_size = self._by_size.get(size)
+        if not same_size:
+            self._by_size[size] = [input_path]
+            return None
+        for candidate in same_size:
+            self._digest(candidate)
+        original = self._by_digest.get(self._digest(input_path))
+        if original == input_path:
+            same_size.append(input_path)
+            return None
+        return original
+
+    def filter(self, paths: Iterable[str]) -> Iterator[str]:
+        """Deja pasar los originales y aparta las copias."""
+        for input_path in paths:
+            try:
+                st = os.stat(input_path)
+                with self._lock:
+                    original = self._original(input_path, st.st_size)
+                    if original is not None:
+                        # Si el original ya terminó, la copia espera a ``resolve_remaining``
+                        duplicate = Duplicate(input_path, st, self._digests[input_path])
+                        self._waiting.setdefault(original, []).append(duplicate)
+                        self.found += 1
+                if original is None:
+                    yield input_path
+            except OSError:
+                # Que falle donde fallaría sin deduplicar
+                yield input_path
+
+    def resolve(self, result: FileResult) -> List[FileResult]:
+        """Materializa las copias de un original ya procesado.
+
+        Devuelve un resultado por copia; las de un original que falló
+        fallan también.
+        """
+        with self._lock:
+            self._done[result.input_path] = result
+            waiting = self._waiting.pop(result.input_path, [])
+        return [self._materialize(result, duplicate) for duplicate in waiting]
+
+    # Copias cuyo original terminó antes de que se descubrieran
+    def resolve_remaining(self) -> List[FileResult]:
+        resolved = []
+        with self._lock:
+            pending = [(self._done.get(original), waiting) for original, waiting in self._waiting.items()]
+            self._waiting.clear()
+        for original, waiting in pending:
+            for duplicate in waiting:
+                if original is None:
+                    # El original no llegó a procesarse (lote cancelado)
+                    continue
+                resolved.append(self._materialize(original, duplicate))
+        return resolved
+
+    def _materialize(self, original: FileResult, duplicate: Duplicate) -> FileResult:
+        base = FileResult(
+            duplicate.input_path,
+            False,
+            input_size=duplicate.st.st_size,
+            input_mtime_ns=duplicate.st.st_mtime_ns,
+            input_hash=duplicate.digest,
+        )
+        if not original.ok:
+            return base._replace(error=f"Duplicado de {original.input_path}, que falló: {original.error}")
+        fmt = formatos.extension_format(os.path.splitext(original.output_path)[1])
+        rel_path = formatos.output_name(os.path.relpath(duplicate.input_path, self.input_dir), fmt)
+        output_path = os.path.join(self.output_dir, rel_path)
+        try:
+            _place(original.output_path, output_path, self.mode)
+        except OSError as e:
+            logger.error("No se pudo copiar %s a %s: %s", original.output_path, output_path, e)
+            return base._replace(error=f"Error al copiar el duplicado: {str(e)}")
+        with self._lock:
+            self.duplicates += 1
+            self.seconds_saved += sum((original.timings or {}).values())
+            self.bytes_saved += duplicate.st.st_size
+        logger.info("Duplicado de %s: %s", original.input_path, output_path)
+        return base._replace(ok=True, output_path=output_path)
+
+
+# Enlace duro o copia, de forma atómica como el resto de salidas
+def _place(source: str, target: str, mode: str) -> None:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = target + ".part"
+    try:
+        if mode == "link":
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+        else:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
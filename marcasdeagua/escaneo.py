@@ -0,0 +1,150 @@
+import fnmatch
+import logging
+import os
+import queue
+import threading
+from typing import Iterable, Iterator, Optional, Sequence
+
+from marcasdeagua import formatos
+
+logger = logging.getLogger(__name__)
+
+# Formatos de entrada que se aceptan al detectar por contenido
+_INPUT_FORMATS = ("JPEG", "PNG", "HEIC")
+
+
+# Un patrón se compara con la ruta relativa (con "/") y con el nombre del archivo
+def _matches(rel_path: str, patterns: Sequence[str]) -> bool:
+    name = rel_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def scan_images(
+    root: str,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    sniff: bool = False,
+) -> Iterator[str]:
+    """Recorre ``root`` con ``os.scandir`` y va entregando imágenes compatibles.
+
+    ``include`` y ``exclude`` son patrones glob; un directorio excluido no se
+    recorre. Con ``sniff`` los archivos sin extensión conocida se identifican
+    por su contenido. Los enlaces simbólicos a directorios no se siguen, igual
+    que ``os.walk``.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            logger.warning(f"No se pudo leer la carpeta {directory}: {str(e)}")
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                rel_path = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                if exclude and _matches(rel_path, exclude):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if include and not _matches(rel_path, include):
+                    continue
+                if entry.name.lower().endswith(formatos.SUPPORTED_EXTENSIONS) or (sniff and _sniff(entry.path)):
+                    yield entry.path
+        # Al revés para que la pila recorra las subcarpetas en orden
+        stack.extend(reversed(subdirs))
+
+
+# Filtros de scan_images para rutas que no están en disco (entradas de un zip/tar):
+# una carpeta excluida excluye todo lo que cuelga de ella
+def matches_filters(rel_path: str, include: Sequence[str] = (), exclude: Sequence[str] = ()) -> bool:
+    parts = rel_path.split("/")
+    if exclude and any(_matches("/".join(parts[:i]), exclude) for i in range(1, len(parts) + 1)):
+        return False
+    return not include or _matches(rel_path, include)
+
+
+# Imagen compatible por extensión o, con ``sniff``, por sus primeros bytes
+def is_image(rel_path: str, head: bytes, sniff: bool = False) -> bool:
+    if rel_path.lower().endswith(formatos.SUPPORTED_EXTENSIONS):
+        return True
+    return sniff and formatos.sniff_format(head[: formatos.SNIFF_BYTES]) in _INPUT_FORMATS
+
+
+def _sniff(file_path: str) -> bool:
+    try:
+        return formatos.sniff_file(file_path) in _INPUT_FORMATS
+    except OSError:
+        return False
+
+
+class ScanQueue:
+    """Productor en segundo plano que llena una cola acotada de rutas.
+
+    El recorrido (y cualquier filtro encadenado, como el manifiesto) avanza
+    en su propio hilo mientras el lote procesa; cuando la cola se llena el
+    recorrido espera, así la memoria no crece con el tamaño del árbol. Si el
+    recorrido falla, el error se vuelve a lanzar al consumidor tras la última
+    ruta entregada.
+    """
+
+    _DONE = object()
+
+    def __init__(self, paths: Iterable[str], maxsize: int = 1024):
+        self.discovered = 0
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(paths,), name="marcasdeagua-scan", daemon=True)
+        self._thread.start()
+
+    def _run(self, paths: Iterable[str]) -> None:
+        try:
+            for path in paths:
+                if self._stop.is_set():
+                    break
+                self.discovered += 1
+                self._put(path)
+        except Exception as e:
+            logger.error(f"Error al recorrer las carpetas: {str(e)}")
+            self.error = e
+        finally:
+            self.finished = True
+            self._put(self._DONE)
+
+    def _put(self, item) -> None:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                # Tras ``close`` el productor ya no entrega nada, ni siquiera el final
+                if self._stop.is_set():
+                    return
+                continue
+            if item is self._DONE:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
@@ -0,0 +1,286 @@
+import io
+import math
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+# Los formatos que necesitan librerías pesadas (pyheif, svglib, reportlab) las
+# importan al usarse, así un lote solo de JPEG/PNG no paga por ellas al arrancar.
+
+SUPPORTED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".heic")
+
+# Marcas ("brands") ISO-BMFF que indican una imagen HEIF/HEIC
+_HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1")
+
+# Bytes de cabecera que necesita sniff_format
+SNIFF_BYTES = 16
+
+
+# Formato según el contenido, no la extensión
+def sniff_format(head: bytes) -> Optional[str]:
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS:
+        return "HEIC"
+    return None
+
+
+def sniff_file(file_path: str) -> Optional[str]:
+    with open(file_path, "rb") as f:
+        return sniff_format(f.read(SNIFF_BYTES))
+
+
+# HEIC por extensión o, si la extensión no es conocida, por contenido
+def is_heic(file_path: str) -> bool:
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".heic":
+        return True
+    if ext in SUPPORTED_EXTENSIONS or ext in LOADERS:
+        return False
+    return sniff_file(file_path) == "HEIC"
+
+
+_EXIF_ORIENTATION = 0x0112
+
+
+# Orientación EXIF de una imagen (1 = tal cual); no hace falta decodificarla
+def exif_orientation(image: Image.Image) -> int:
+    return image.getexif().get(_EXIF_ORIENTATION, 1)
+
+
+# EXIF de un contenedor HEIF: libheif lo entrega con un prefijo de 4 bytes
+# (desplazamiento hasta la cabecera TIFF) que Pillow no espera
+def _heif_exif(raw: bytes) -> Optional[bytes]:
+    for marker in (b"Exif\x00\x00", b"II*\x00", b"MM\x00*"):
+        start = raw.find(marker)
+        if start != -1:
+            return raw[start:]
+    return None
+
+
+# Copia EXIF e ICC del HEIC a ``image.info``. pyheif ya aplica la rotación del
+# contenedor, así que la orientación EXIF se deja en 1 para no girar dos veces.
+def _heif_metadata(heif_file, image: Image.Image) -> None:
+    for block in heif_file.metadata or ():
+        if block.get("type") != "Exif":
+            continue
+        exif_bytes = _heif_exif(block["data"])
+        if exif_bytes:
+            exif = Image.Exif()
+            exif.load(exif_bytes)
+            if exif.get(_EXIF_ORIENTATION, 1) != 1:
+                exif[_EXIF_ORIENTATION] = 1
+            image.info["exif"] = exif.tobytes()
+        break
+    profile = heif_file.color_profile
+    if profile and profile.get("type") in ("prof", "rICC"):
+        image.info["icc_profile"] = profile["data"]
+
+
+def load_heic(file_path: str, data: Optional[bytes] = None) -> Image.Image:
+    """Decodifica un HEIC envolviendo el búfer de libheif sin copiarlo.
+
+    En RGBA Pillow usa el búfer decodificado tal cual; en RGB tiene que
+    desempaquetarlo (guarda 4 bytes por píxel), que es la única copia. Cada
+    llamada tiene su propio decodificador, así que puede usarse desde muchos
+    procesos a la vez.
+    """
+    import pyheif
+
+    heif_file = pyheif.read(file_path if data is None else data)
+    image = Image.frombuffer(
+        heif_file.mode,
+        heif_file.size,
+        heif_file.data,
+        "raw",
+        heif_file.mode,
+        heif_file.stride,
+        1,
+    )
+    if image.readonly:
+        # La imagen apunta a memoria de libheif: la mantenemos viva con ella.
+        # Ese búfer es solo de esta imagen, así que si admite escritura
+        # componemos encima en lugar de que Pillow lo copie al pegar.
+        image._heif_file = heif_file
+        if not memoryview(heif_file.data).readonly:
+            image.readonly = 0
+    image.format = "HEIC"
+    _heif_metadata(heif_file, image)
+    return image
+
+
+# El SVG se interpreta una vez por versión del archivo (ruta + mtime)
+@lru_cache(maxsize=8)
+def _svg_drawing(file_path: str, mtime_ns: int):
+    from svglib.svglib import svg2rlg
+
+    drawing = svg2rlg(file_path)
+    if drawing is None:
+        raise ValueError(f"SVG inválido: {file_path}")
+    return drawing
+
+
+def svg_version(file_path: str) -> int:
+    return os.stat(file_path).st_mtime_ns
+
+
+def svg_native_size(file_path: str, mtime_ns: int) -> Tuple[int, int]:
+    drawing = _svg_drawing(file_path, mtime_ns)
+    return int(drawing.width + 0.5), int(drawing.height + 0.5)
+
+
+# Rasterizado directo a memoria al tamaño exacto pedido, sin pasar por PNG.
+# Las imágenes devueltas se comparten entre llamadas: no modificarlas.
+@lru_cache(maxsize=64)
+def render_svg(file_path: str, mtime_ns: int, size: Tuple[int, int]) -> Image.Image:
+    from reportlab.graphics import renderPM
+    from reportlab.graphics.shapes import Drawing
+
+    drawing = _svg_drawing(file_path, mtime_ns)
+    width, height = size
+    if (width, height) != svg_native_size(file_path, mtime_ns):
+        sx = width / drawing.width
+        sy = height / drawing.height
+        drawing = Drawing(width, height, drawing, transform=(sx, 0, 0, sy, 0, 0))
+    return renderPM.drawToPIL(drawing)
+
+
+def load_svg(file_path: str, data: Optional[bytes] = None) -> Image.Image:
+    mtime_ns = svg_version(file_path)
+    return render_svg(file_path, mtime_ns, svg_native_size(file_path, mtime_ns))
+
+
+# Reducción barata para vistas previas, a un tamaño no menor que ``size``.
+# JPEG decodifica directamente a 1/2, 1/4 o 1/8; lo ya decodificado (HEIC,
+# que pyheif no sabe decodificar reducido) se reduce por un factor entero.
+def draft(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    if image.format == "JPEG":
+        image.draft("RGB", size)
+        return image
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2 and image.format == "HEIC":
+        reduced = image.reduce(factor)
+        reduced.format = image.format
+        reduced.info = image.info
+        return reduced
+    return image
+
+
+# Mismo cálculo que Image.thumbnail: tamaño que conserva la proporción y cabe en bound
+def fit_size(size: Tuple[int, int], bound: Tuple[int, int]) -> Tuple[int, int]:
+    width, height = size
+    x, y = bound
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+# Cargadores especiales por extensión; el resto lo abre Pillow directamente
+LOADERS: Dict[str, Callable[..., Image.Image]] = {
+    ".heic": load_heic,
+    ".svg": load_svg,
+}
+
+
+def open_image(file_path: str, data: Optional[bytes] = None) -> Image.Image:
+    """Abre una imagen desde disco o desde sus bytes ya leídos (``data``).
+
+    Si la extensión no es conocida se mira el contenido, así un HEIC con otro
+    nombre también llega a su cargador.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    loader = LOADERS.get(ext)
+    if loader is None and ext not in SUPPORTED_EXTENSIONS:
+        head = data[:SNIFF_BYTES] if data is not None else None
+        if (sniff_format(head) if head is not None else sniff_file(file_path)) == "HEIC":
+            loader = load_heic
+    if loader:
+        return loader(file_path, data)
+    return Image.open(file_path if data is None else io.BytesIO(data))
+
+
+# Formatos de salida que sabemos escribir y las extensiones que les corresponden
+OUTPUT_EXTENSIONS: Dict[str, Tuple[str, ...]] = {
+    "JPEG": (".jpg", ".jpeg", ".jpe"),
+    "PNG": (".png",),
+    "WEBP": (".webp",),
+}
+
+
+# Formato de salida que corresponde a una extensión (JPEG si no es ninguna)
+def extension_format(ext: str) -> str:
+    ext = ext.lower()
+    return next((fmt for fmt, exts in OUTPUT_EXTENSIONS.items() if ext in exts), "JPEG")
+
+
+@dataclass(frozen=True)
+class EncodeOptions:
+    """Cómo se codifica cada imagen de salida.
+
+    ``format`` es ``"original"`` (el formato de la fuente; JPEG si no se puede
+    escribir, como HEIC) o uno de ``OUTPUT_EXTENSIONS``. ``quality`` se aplica
+    a JPEG y WebP, ``compress_level`` (0-9) a PNG y ``webp_method`` (0-6)
+    cambia velocidad por tamaño en WebP.
+    """
+
+    format: str = "original"
+    quality: int = 90
+    compress_level: int = 6
+    webp_method: int = 4
+    progressive: bool = False
+    optimize: bool = False
+    keep_exif: bool = True
+    keep_icc: bool = True
+
+    def __post_init__(self):
+        fmt = self.format.upper()
+        if fmt != "ORIGINAL" and fmt not in OUTPUT_EXTENSIONS:
+            raise ValueError(f"Formato de salida no soportado: {self.format}")
+        object.__setattr__(self, "format", fmt.lower() if fmt == "ORIGINAL" else fmt)
+
+    def output_format(self, source_format: Optional[str]) -> str:
+        if self.format != "original":
+            return self.format
+        if source_format in OUTPUT_EXTENSIONS:
+            return source_format
+        return "JPEG"
+
+    def save_params(self, fmt: str, info: dict) -> dict:
+        params = {}
+        if fmt == "JPEG":
+            params.update(quality=self.quality, optimize=self.optimize, progressive=self.progressive)
+        elif fmt == "WEBP":
+            params.update(quality=self.quality, method=self.webp_method)
+        elif fmt == "PNG":
+            params.update(compress_level=self.compress_level, optimize=self.optimize)
+        if self.keep_exif and info.get("exif"):
+            params["exif"] = info["exif"]
+        if self.keep_icc and info.get("icc_profile"):
+            params["icc_profile"] = info["icc_profile"]
+        return params
+
+
+# Si la extensión no corresponde al formato de salida se añade la nueva tras
+# la original ("IMG_1.heic" -> "IMG_1.heic.jpg"): así "IMG_1.heic" e
+# "IMG_1.jpg" de la misma carpeta no acaban en el mismo archivo
+def output_name(rel_path: str, fmt: str) -> str:
+    ext = os.path.splitext(rel_path)[1]
+    if ext.lower() in OUTPUT_EXTENSIONS[fmt]:
+        return rel_path
+    return rel_path + OUTPUT_EXTENSIONS[fmt][0]
@@ -0,0 +1,615 @@
+import os
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+from marcasdeagua import archivos, escaneo, formatos, memoria
+from marcasdeagua.duplicados import Deduplicator
+from marcasdeagua.formatos import EncodeOptions
+from marcasdeagua.manifiesto import Manifest, data_digest, file_digest, job_fingerprint
+from marcasdeagua.metricas import RunReport, Timer
+from marcasdeagua.nucleo import FileResult, TileOptions, compose_image, load_watermark, save_image, watermark_bytes
+
+logger = logging.getLogger(__name__)
+
+
+# Resumen de un lote completo
+@dataclass
+class BatchResult:
+    processed: int = 0
+    failed: int = 0
+    skipped: int = 0
+    errors: List[FileResult] = field(default_factory=list)
+    cache_hits: int = 0
+    cache_misses: int = 0
+    cancelled: bool = False
+    # Memoria: pico residente del proceso principal y del mayor proceso de
+    # trabajo, y pico de memoria estimada en curso (con presupuesto)
+    peak_rss: Optional[int] = None
+    peak_rss_workers: Optional[int] = None
+    peak_estimated: int = 0
+    # Entradas repetidas que no se procesaron (su salida se copió del original)
+    duplicates: int = 0
+    dedup_seconds_saved: float = 0.0
+    # Latencias por etapa, bytes y rendimiento por formato (ver metricas.RunReport)
+    report: RunReport = field(default_factory=RunReport)
+
+    def add(self, result: FileResult) -> None:
+        self.report.add(result)
+        self.cache_hits += result.cache_hits
+        self.cache_misses += result.cache_misses
+        if result.ok:
+            self.processed += 1
+        else:
+            self.failed += 1
+            self.errors.append(result)
+
+
+# Avance de un lote, para barras de progreso
+@dataclass
+class Progress:
+    done: int
+    total: int
+    elapsed: float
+    # Mientras se sigue recorriendo el árbol, ``total`` es lo encontrado hasta ahora
+    scanning: bool = False
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.files_per_sec
+        if rate <= 0 or self.scanning:
+            return None
+        return (self.total - self.done) / rate
+
+
+# Todo lo que un proceso de trabajo necesita saber del lote (serializable)
+@dataclass(frozen=True)
+class JobConfig:
+    watermark_path: str
+    input_dir: str
+    output_dir: str
+    x: int
+    y: int
+    watermark_cache_size: int = 32
+    encode: EncodeOptions = field(default_factory=EncodeOptions)
+    hash_inputs: bool = False
+    tile: Optional[TileOptions] = None
+
+    # Parámetros que cambian el resultado; si cambian, el manifiesto se invalida
+    def output_params(self) -> dict:
+        params = {"x": self.x, "y": self.y, "encode": asdict(self.encode)}
+        if self.tile:
+            params["tile"] = asdict(self.tile)
+        return params
+
+
+# Leer la entrada entera una vez: sirve para decodificar y para el hash.
+# Con ``lean`` (imágenes enormes) no se guardan los bytes: se decodifica
+# directamente del disco y el hash se calcula por bloques.
+def _read_input(input_path: str, hash_inputs: bool, lean: bool = False) -> Tuple[Optional[bytes], os.stat_result, Optional[str]]:
+    if lean:
+        st = os.stat(input_path)
+        return None, st, file_digest(input_path) if hash_inputs else None
+    with open(input_path, "rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    return data, st, data_digest(data) if hash_inputs else None
+
+
+# Estado de cada proceso de trabajo: la marca de agua se carga una sola vez
+_worker_state = {}
+
+
+def _init_worker(job: JobConfig) -> None:
+    _worker_state.update(job=job, watermark=load_watermark(job.watermark_path, job.watermark_cache_size, job.tile))
+
+
+# Decodificar y componer con el estado del proceso; devuelve lo necesario para guardar
+def _compose_task(
+    input_path: str, data: Optional[bytes], st: os.stat_result, digest: Optional[str], timer: Optional[Timer] = None
+):
+    job = _worker_state["job"]
+    watermark = _worker_state["watermark"]
+    hits, misses = watermark.cache.hits, watermark.cache.misses
+    composed = compose_image(
+        input_path, watermark, job.input_dir, job.output_dir, job.x, job.y, job.encode, data, timer
+    )
+    extra = dict(
+        cache_hits=watermark.cache.hits - hits,
+        cache_misses=watermark.cache.misses - misses,
+        input_size=st.st_size,
+        input_mtime_ns=st.st_mtime_ns,
+        input_hash=digest,
+    )
+    return composed, extra
+
+
+def _process_task(input_path: str, lean: bool = False) -> FileResult:
+    job = _worker_state["job"]
+    timer = Timer()
+    try:
+        try:
+            with timer.stage("read"):
+                data, st, digest = _read_input(input_path, job.hash_inputs, lean)
+        except OSError as e:
+            logger.error("No se pudo leer %s: %s", input_path, e)
+            return FileResult(input_path, False, f"Error al cargar: {str(e)}")
+        composed, extra = _compose_task(input_path, data, st, digest, timer)
+        del data
+        if isinstance(composed, FileResult):
+            return composed._replace(**extra)
+        return save_image(input_path, composed, job.encode)._replace(**extra)
+    except Exception as e:
+        # Nunca dejamos que un archivo tumbe al proceso de trabajo
+        logger.error("Error inesperado con %s: %s", input_path, e)
+        return FileResult(input_path, False, str(e))
+
+
+# Procesar una entrada de un zip/tar (o ya leída) sin tocar el disco; devuelve
+# el resultado, con el nombre de salida relativo, y los bytes codificados
+def _entry_task(name: str, data: bytes) -> Tuple[FileResult, Optional[bytes]]:
+    job = _worker_state["job"]
+    watermark = _worker_state["watermark"]
+    hits, misses = watermark.cache.hits, watermark.cache.misses
+    timer = Timer()
+    extra = dict(input_size=len(data), timings=timer.durations)
+    try:
+        output, fmt = watermark_bytes(data, watermark, job.x, job.y, job.encode, name=name, timer=timer)
+    except Exception as e:
+        logger.error("No se pudo procesar %s: %s", name, e)
+        return FileResult(name, False, f"Error al procesar: {str(e)}", **extra), None
+    decoded = next((key for key in timer.durations if key.startswith("decode:")), "decode:?")
+    return (
+        FileResult(
+            name,
+            True,
+            cache_hits=watermark.cache.hits - hits,
+            cache_misses=watermark.cache.misses - misses,
+            output_path=formatos.output_name(name, fmt),
+            output_size=len(output),
+            input_format=decoded.split(":", 1)[1],
+            **extra,
+        ),
+        output,
+    )
+
+
+def _run_entries(
+    entries: Iterable[Tuple[str, bytes]],
+    job: JobConfig,
+    writer: archivos.EntryWriter,
+    collect: Callable[[FileResult], None],
+    cancelled: Callable[[], bool],
+    workers: int,
+) -> None:
+    """Lote de zip/tar: las entradas pasan de memoria a memoria sin temporales.
+
+    Los procesos de trabajo devuelven los bytes codificados y este proceso los
+    escribe en el destino, que es único (un zip o tar no admite escritores
+    paralelos). La estructura de carpetas de dentro se conserva.
+    """
+
+    def store(file_result: FileResult, output: Optional[bytes]) -> None:
+        if output is not None:
+            start = time.perf_counter()
+            try:
+                file_result = file_result._replace(output_path=writer.write(file_result.output_path, output))
+                file_result.timings["write"] = time.perf_counter() - start
+                logger.info("Imagen con marca de agua guardada: %s", file_result.output_path)
+            except (OSError, ValueError) as e:
+                logger.error("No se pudo guardar %s: %s", file_result.output_path, e)
+                file_result = file_result._replace(ok=False, error=f"Error al guardar: {str(e)}", output_path=None)
+        collect(file_result)
+
+    if workers <= 1:
+        _init_worker(job)
+        for name, data in entries:
+            if cancelled():
+                break
+            store(*_entry_task(name, data))
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(job,)) as executor:
+        pending = set()
+        for name, data in entries:
+            if cancelled():
+                break
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    store(*future.result())
+            pending.add(executor.submit(_entry_task, name, data))
+        if cancelled():
+            for future in pending:
+                future.cancel()
+        for future in wait(pending).done:
+            if not future.cancelled():
+                store(*future.result())
+
+
+def _run_pipeline(
+    paths: Iterable[str],
+    job: JobConfig,
+    collect: Callable[[FileResult], None],
+    cancelled: Callable[[], bool],
+    budget: Optional[memoria.MemoryBudget] = None,
+    depth: int = 4,
+) -> None:
+    """Lote en un solo proceso como tubería de tres etapas solapadas.
+
+    Un hilo lee archivos, este hilo decodifica y compone, y otro codifica y
+    escribe. Las colas entre etapas son acotadas: si una etapa se atrasa, las
+    anteriores esperan en lugar de acumular imágenes en memoria. Con
+    ``budget`` el lector además espera a que la memoria estimada de cada
+    imagen quepa en el presupuesto antes de leerla.
+    """
+    _init_worker(job)
+    read_queue: "queue.Queue" = queue.Queue(depth)
+    write_queue: "queue.Queue" = queue.Queue(2)
+    results: "queue.Queue" = queue.Queue()
+
+    costs = {}
+    # Error del recorrido (p. ej. un zip truncado): se relanza en este hilo
+    scan_errors: List[Exception] = []
+    # Se activa al salir (también por error o Ctrl-C) para que el lector no siga leyendo
+    stop = threading.Event()
+
+    def release(input_path: str) -> None:
+        if budget:
+            budget.release(costs.pop(input_path, 0))
+
+    def reader() -> None:
+        try:
+            for input_path in paths:
+                if cancelled() or stop.is_set():
+                    break
+                lean = False
+                if budget:
+                    cost = costs[input_path] = memoria.estimate_footprint(input_path)
+                    lean = cost > budget.limit
+                    if lean:
+                        logger.warning(
+                            "%s necesita ~%s, más que el presupuesto: se procesa en solitario",
+                            input_path,
+                            memoria.format_bytes(cost),
+                        )
+                    budget.acquire(cost)
+                timer = Timer()
+                try:
+                    with timer.stage("read"):
+                        read = _read_input(input_path, job.hash_inputs, lean)
+                    read_queue.put((input_path, read, None, timer))
+                except OSError as e:
+                    read_queue.put((input_path, None, e, timer))
+        except Exception as e:
+            scan_errors.append(e)
+        finally:
+            read_queue.put(None)
+
+    def writer() -> None:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            input_path, composed, extra = item
+            try:
+                results.put(save_image(input_path, composed, job.encode)._replace(**extra))
+            except Exception as e:
+                logger.error("Error inesperado con %s: %s", input_path, e)
+                results.put(FileResult(input_path, False, str(e)))
+            finally:
+                del composed, item
+                release(input_path)
+
+    def drain() -> None:
+        while True:
+            try:
+                collect(results.get_nowait())
+            except queue.Empty:
+                return
+
+    threads = [
+        threading.Thread(target=reader, name="marcasdeagua-read", daemon=True),
+        threading.Thread(target=writer, name="marcasdeagua-write", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    item = ()
+    try:
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            input_path, read, error, timer = item
+            if cancelled():
+                # Seguimos vaciando la cola para que el lector pueda terminar
+                release(input_path)
+                continue
+            if error is not None:
+                logger.error("No se pudo leer %s: %s", input_path, error)
+                results.put(FileResult(input_path, False, f"Error al cargar: {str(error)}"))
+                release(input_path)
+            else:
+                try:
+                    composed, extra = _compose_task(input_path, *read, timer)
+                except Exception as e:
+                    logger.error("Error inesperado con %s: %s", input_path, e)
+                    composed, extra = FileResult(input_path, False, str(e)), {}
+                if isinstance(composed, FileResult):
+                    results.put(composed._replace(**extra))
+                    release(input_path)
+                else:
+                    write_queue.put((input_path, composed, extra))
+            drain()
+        if scan_errors:
+            raise scan_errors[0]
+    finally:
+        # Si salimos antes de tiempo, paramos el recorrido y vaciamos la cola
+        # para que el lector termine sin leer el resto del árbol
+        stop.set()
+        if isinstance(paths, escaneo.ScanQueue):
+            paths.close()
+        while item is not None:
+            if item:
+                release(item[0])
+            item = read_queue.get()
+        write_queue.put(None)
+        for thread in threads:
+            thread.join()
+        drain()
+
+
+# Procesar carpeta
+def process_folder(
+    input_dir: str,
+    watermark_path: str,
+    output_dir: str,
+    x: int,
+    y: int,
+    workers: Optional[int] = None,
+    on_result: Optional[Callable[[FileResult], None]] = None,
+    watermark_cache_size: int = 32,
+    encode: Optional[EncodeOptions] = None,
+    incremental: bool = False,
+    on_progress: Optional[Callable[[Progress], None]] = None,
+    progress_interval: float = 0.25,
+    cancel: Optional[threading.Event] = None,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    sniff: bool = False,
+    queue_size: int = 1024,
+    memory_budget: Optional[int] = None,
+    tile: Optional[TileOptions] = None,
+    dedup: Optional[str] = None,
+) -> BatchResult:
+    """Aplica la marca de agua a todas las imágenes de ``input_dir``.
+
+    Con ``workers`` > 1 las imágenes se reparten entre varios procesos; cada
+    uno carga la marca de agua una vez y va tomando rutas de la cola del pool.
+    Con ``workers=1`` todo se hace en el proceso actual, como una tubería de
+    lectura, composición y escritura solapadas. ``None`` usa todos los núcleos
+    disponibles. ``watermark_cache_size`` acota cuántos tamaños distintos de
+    la marca guarda cada proceso. ``encode`` elige formato y parámetros de
+    salida (por defecto, el mismo formato que la fuente).
+
+    El árbol se recorre en segundo plano y las rutas llegan por una cola de
+    ``queue_size`` elementos, así el procesamiento empieza con el primer
+    archivo encontrado. ``include``/``exclude`` son patrones glob y ``sniff``
+    identifica por contenido los archivos sin extensión conocida.
+
+    Con ``incremental`` se mantiene un manifiesto en ``output_dir`` y solo se
+    procesan las entradas nuevas o cambiadas; cambiar la marca de agua o los
+    parámetros invalida todo.
+
+    Con ``memory_budget`` (bytes) se estima desde la cabecera cuánta memoria
+    necesitará cada imagen y solo se admite trabajo mientras el total en curso
+    quepa en el presupuesto. Una imagen que no cabe ni sola se procesa en
+    solitario y sin guardar sus bytes comprimidos en memoria.
+
+    ``on_progress`` recibe el avance como mucho cada ``progress_interval``
+    segundos (y una vez al final), pensado para refrescar una interfaz sin
+    saturarla. Si se activa ``cancel`` no se reparten más archivos: los que
+    están en curso terminan y todo lo ya escrito se conserva.
+
+    ``input_dir`` también puede ser un zip o un tar, y ``output_dir`` un
+    ``.zip``/``.tar``/``.tar.gz``: las entradas se leen, procesan y escriben
+    en memoria, sin extraer nada a disco (no admite ``incremental`` ni
+    ``memory_budget``).
+
+    Con ``dedup`` (``"copy"`` o ``"link"``) las entradas con el mismo
+    contenido se procesan una vez y la salida del original se copia o se
+    enlaza para las demás; solo se calcula el hash de los archivos con un
+    tamaño repetido.
+
+    Con ``tile`` la marca se repite en mosaico sobre toda la imagen (y se
+    ignoran ``x``/``y``); ver ``TileOptions``.
+
+    ``BatchResult.report`` reúne los tiempos por etapa de cada archivo
+    (lectura, decodificación, marca, composición, codificación y escritura)
+    para exportarlos como JSON o para Prometheus.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Una entrada que no existe (una errata, un disco sin montar) no es un lote vacío
+    input_is_archive = archivos.is_archive(input_dir)
+    if not input_is_archive:
+        if not os.path.isdir(input_dir):
+            raise FileNotFoundError(f"La entrada no es una carpeta ni un zip/tar: {input_dir}")
+        if not os.access(input_dir, os.R_OK | os.X_OK):
+            raise PermissionError(f"No se puede leer la carpeta de entrada: {input_dir}")
+    # Validamos la marca de agua aquí para fallar antes de lanzar procesos
+    load_watermark(watermark_path, cache_size=0)
+    job = JobConfig(
+        watermark_path,
+        input_dir,
+        output_dir,
+        x,
+        y,
+        watermark_cache_size,
+        encode or EncodeOptions(),
+        hash_inputs=incremental,
+        tile=tile,
+    )
+    result = BatchResult()
+    archive_mode = input_is_archive or bool(archivos.archive_kind(output_dir))
+    if archive_mode and (incremental or memory_budget or dedup):
+        raise ValueError(
+            "Con zip/tar no se puede usar el modo incremental, el presupuesto de memoria ni la deduplicación"
+        )
+    manifest = None
+    if archive_mode:
+        # Las entradas llevan sus bytes: la cola se acota a lo que pueden consumir los procesos
+        paths = archivos.iter_entries(input_dir, include, exclude, sniff)
+        queue_size = min(queue_size, workers * 2)
+    else:
+        paths = escaneo.scan_images(input_dir, include, exclude, sniff)
+    if incremental:
+        manifest = Manifest.load(output_dir, job_fingerprint(watermark_path, job.output_params()))
+
+        def skip(input_path: str) -> None:
+            result.skipped += 1
+
+        paths = manifest.pending(paths, input_dir, on_skip=skip)
+    deduplicator = Deduplicator(input_dir, output_dir, dedup) if dedup else None
+    if deduplicator:
+        paths = deduplicator.filter(paths)
+    scan = escaneo.ScanQueue(paths, queue_size)
+    started = time.monotonic()
+    last_progress = 0.0
+
+    def report_progress(force: bool = False) -> None:
+        nonlocal last_progress
+        now = time.monotonic()
+        if on_progress and (force or now - last_progress >= progress_interval):
+            last_progress = now
+            done = result.processed + result.failed
+            # Las copias apartadas por el deduplicador no pasan por la cola de rutas
+            total = scan.discovered + (deduplicator.found if deduplicator else 0)
+            on_progress(Progress(done, total, now - started, scanning=not scan.finished))
+
+    def cancelled() -> bool:
+        if cancel is not None and cancel.is_set():
+            result.cancelled = True
+        return result.cancelled
+
+    def collect(file_result: FileResult, duplicate: bool = False) -> None:
+        # Las copias de un duplicado cuentan como cualquier otro archivo: el
+        # total cuadra con el de un lote sin deduplicar
+        result.add(file_result)
+        report_progress()
+        if manifest and file_result.ok:
+            manifest.record(
+                os.path.relpath(file_result.input_path, input_dir),
+                file_result.input_size,
+                file_result.input_mtime_ns,
+                file_result.input_hash,
+                os.path.relpath(file_result.output_path, output_dir),
+            )
+        if on_result:
+            on_result(file_result)
+        if deduplicator and not duplicate:
+            for copy_result in deduplicator.resolve(file_result):
+                collect(copy_result, duplicate=True)
+
+    budget = memoria.MemoryBudget(memory_budget) if memory_budget else None
+    try:
+        if archive_mode:
+            with archivos.EntryWriter(output_dir) as writer:
+                _run_entries(scan, job, writer, collect, cancelled, workers)
+        elif workers <= 1:
+            _run_pipeline(scan, job, collect, cancelled, budget)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(job,)) as executor:
+                # Limitamos las tareas en vuelo para no cargar todo el árbol en memoria
+                max_pending = workers * 4
+                pending = set()
+                costs = {}
+
+                def finish(futures) -> None:
+                    for future in futures:
+                        cost = costs.pop(future, 0)
+                        if budget:
+                            budget.release(cost)
+                        if not future.cancelled():
+                            collect(future.result())
+
+                for input_path in scan:
+                    if cancelled():
+                        break
+                    cost = memoria.estimate_footprint(input_path) if budget else 0
+                    while pending and (len(pending) >= max_pending or (budget and not budget.fits(cost))):
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        finish(done)
+                    lean = bool(budget) and cost > budget.limit
+                    if lean:
+                        logger.warning(
+                            "%s necesita ~%s, más que el presupuesto: se procesa en solitario",
+                            input_path,
+                            memoria.format_bytes(cost),
+                        )
+                    future = executor.submit(_process_task, input_path, lean)
+                    pending.add(future)
+                    if budget:
+                        budget.take(cost)
+                        costs[future] = cost
+                if cancelled():
+                    # Lo que aún no empezó se descarta; lo que está en marcha termina
+                    for future in pending:
+                        future.cancel()
+                finish(wait(pending).done)
+        if deduplicator:
+            for copy_result in deduplicator.resolve_remaining():
+                collect(copy_result, duplicate=True)
+    finally:
+        scan.close()
+        if manifest:
+            manifest.save()
+    if deduplicator:
+        result.duplicates = deduplicator.duplicates
+        result.dedup_seconds_saved = deduplicator.seconds_saved
+    result.peak_rss = memoria.peak_rss()
+    result.peak_rss_workers = memoria.peak_rss(children=True) if workers > 1 else None
+    result.peak_estimated = budget.peak if budget else 0
+    result.report.finish(
+        skipped=result.skipped,
+        cancelled=result.cancelled,
+        workers=workers,
+        watermark_cache={"hits": result.cache_hits, "misses": result.cache_misses},
+        peak_rss=result.peak_rss,
+        peak_rss_workers=result.peak_rss_workers,
+        peak_estimated=result.peak_estimated,
+        duplicates={
+            "count": result.duplicates,
+            "seconds_saved": result.dedup_seconds_saved,
+            "bytes_saved": deduplicator.bytes_saved if deduplicator else 0,
+        },
+    )
+    report_progress(force=True)
+    if result.cancelled:
+        logger.info("Lote cancelado: se conservan las imágenes ya guardadas.")
+    logger.info(
+        "Procesadas %d imágenes. Fallidas: %d. Sin cambios: %d.", result.processed, result.failed, result.skipped
+    )
+    if deduplicator:
+        logger.info(
+            "Duplicados: %d (ahorro estimado: %.1f s de proceso).", result.duplicates, result.dedup_seconds_saved
+        )
+    logger.info("Caché de marca de agua: %d aciertos, %d fallos.", result.cache_hits, result.cache_misses)
+    logger.info("Memoria máxima: %s.", memory_summary(result))
+    return result
+
+
+def memory_summary(result: BatchResult) -> str:
+    summary = f"{memoria.format_bytes(result.peak_rss)} en el proceso principal"
+    if result.peak_rss_workers is not None:
+        summary += f", {memoria.format_bytes(result.peak_rss_workers)} en el mayor proceso de trabajo"
+    if result.peak_estimated:
+        summary += f" (estimado en curso: {memoria.format_bytes(result.peak_estimated)})"
+    return summary
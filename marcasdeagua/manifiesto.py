@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".marcasdeagua-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _new_digest():
+    return hashlib.blake2b(digest_size=20)
+
+
+# Hash de unos bytes ya leídos (mismo valor que file_digest)
+def data_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+# Hash del contenido de un archivo, leído por bloques
+def file_digest(file_path: str, chunk_size: int = 1 << 20) -> str:
+    digest = _new_digest()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Huella de la marca de agua y los parámetros: si cambia, todo se rehace
+def job_fingerprint(watermark_path: str, params: dict) -> str:
+    digest = _new_digest()
+    digest.update(file_digest(watermark_path).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Registro de lo ya procesado, guardado en la carpeta de salida.
+
+    Por cada entrada (ruta relativa) guarda tamaño, mtime, hash del contenido
+    y la salida generada. Una entrada está al día si la salida existe y el
+    archivo no ha cambiado; si solo cambió el mtime se compara el hash. Se
+    escribe de forma atómica cada pocos segundos, así una ejecución
+    interrumpida puede retomarse sin rehacer lo terminado. Es seguro usarlo
+    desde el hilo que recorre las carpetas y el que recoge resultados a la vez.
+    """
+
+    def __init__(self, output_dir: str, fingerprint: str, files: Optional[Dict[str, dict]] = None):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.fingerprint = fingerprint
+        self.files: Dict[str, dict] = files or {}
+        self.flush_interval = 5.0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, output_dir: str, fingerprint: str) -> "Manifest":
+        path = os.path.join(output_dir, MANIFEST_NAME)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(output_dir, fingerprint)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Manifiesto ilegible, se procesará todo: {path}: {str(e)}")
+            return cls(output_dir, fingerprint)
+        if data.get("version") != MANIFEST_VERSION or data.get("fingerprint") != fingerprint:
+            logger.info("La marca de agua o los parámetros cambiaron: se procesará todo.")
+            return cls(output_dir, fingerprint)
+        return cls(output_dir, fingerprint, data.get("files", {}))
+
+    def is_up_to_date(self, rel_path: str, st: os.stat_result, input_path: str) -> bool:
+        with self._lock:
+            entry = self.files.get(rel_path)
+        if not entry or entry["size"] != st.st_size:
+            return False
+        if not os.path.exists(os.path.join(self.output_dir, entry["output"])):
+            return False
+        if entry["mtime_ns"] == st.st_mtime_ns:
+            return True
+        # Mismo tamaño pero otro mtime: decide el contenido
+        if file_digest(input_path) != entry["hash"]:
+            return False
+        with self._lock:
+            entry["mtime_ns"] = st.st_mtime_ns
+            self._dirty = True
+        return True
+
+    def pending(
+        self, paths: Iterable[str], input_dir: str, on_skip: Optional[Callable[[str], None]] = None
+    ) -> Iterator[str]:
+        """Devuelve solo las rutas nuevas o cambiadas y olvida las que ya no existen."""
+        seen = set()
+        for input_path in paths:
+            rel_path = os.path.relpath(input_path, input_dir)
+            seen.add(rel_path)
+            try:
+                up_to_date = self.is_up_to_date(rel_path, os.stat(input_path), input_path)
+            except OSError:
+                up_to_date = False
+            if up_to_date:
+                if on_skip:
+                    on_skip(input_path)
+            else:
+                yield input_path
+        with self._lock:
+            for rel_path in set(self.files) - seen:
+                del self.files[rel_path]
+                self._dirty = True
+
+    def record(self, rel_path: str, size: int, mtime_ns: int, digest: str, output_rel_path: str) -> None:
+        with self._lock:
+            self.files[rel_path] = {"size": size, "mtime_ns": mtime_ns, "hash": digest, "output": output_rel_path}
+            self._dirty = True
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            os.makedirs(self.output_dir, exist_ok=True)
+            data = {"version": MANIFEST_VERSION, "fingerprint": self.fingerprint, "files": self.files}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
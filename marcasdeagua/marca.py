@@ -1,13 +1,11 @@
 import flet as ft
 import os
 from pathlib import Path
-from PIL import Image
-import pyheif
-from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPM
-import io
 import logging
-import base64
+import threading
+
+from marcasdeagua import lote, nucleo
+from marcasdeagua.vista_previa import PreviewSession
 
 # Configuramos el sistema de logs
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -56,6 +54,11 @@ def main(page: ft.Page):
     
     status_snackbar = ft.SnackBar(content=ft.Text("Listo para empezar"), bgcolor=ft.colors.BLUE_100)
 
+    # Progreso del lote en curso
+    progress_bar = ft.ProgressBar(value=0, visible=False)
+    progress_text = ft.Text("", size=14, color=ft.colors.GREY_700)
+    cancel_event = threading.Event()
+
     # Selectores de archivos
     folder_picker = ft.FilePicker(
         on_result=lambda e: [setattr(folder_path, "value", e.path or ""), page.update()]
@@ -108,82 +111,34 @@ def main(page: ft.Page):
         page.theme_mode = ft.ThemeMode.DARK if page.theme_mode == ft.ThemeMode.LIGHT else ft.ThemeMode.LIGHT
         page.update()
 
-    # Cargar imagen
-    def load_image(file_path: str) -> Image.Image:
-        ext = os.path.splitext(file_path)[1].lower()
-        try:
-            if ext == ".heic":
-                heif_file = pyheif.read(file_path)
-                image = Image.frombytes(
-                    heif_file.mode,
-                    heif_file.size,
-                    heif_file.data,
-                    "raw",
-                    heif_file.mode,
-                    heif_file.stride,
-                )
-            elif ext == ".svg":
-                drawing = svg2rlg(file_path)
-                img_data = io.BytesIO()
-                renderPM.drawToFile(drawing, img_data, fmt="PNG")
-                image = Image.open(img_data)
-            else:
-                image = Image.open(file_path)
-            return image.convert("RGBA")
-        except Exception as e:
-            logger.error(f"No se pudo cargar la imagen {file_path}: {str(e)}")
-            show_error_dialog(f"Error al cargar {file_path}: {str(e)}")
-            return None
+    # Vista previa en memoria: la base y la marca se preparan una vez y mover
+    # las coordenadas solo recompone
+    preview_session = PreviewSession()
+    preview_sources = {}
+    preview_image = ft.Image(src_base64="", fit=ft.ImageFit.CONTAIN, border_radius=8, expand=True)
 
-    # Cargar imagen Base64
-    def load_base64_image(base64_str: str) -> Image.Image:
-        try:
-            if base64_str.startswith("data:image"):
-                base64_str = base64_str.split(",")[1]
-            img_data = base64.b64decode(base64_str)
-            image = Image.open(io.BytesIO(img_data))
-            return image.convert("RGBA")
-        except Exception as e:
-            logger.error(f"No se pudo decodificar la imagen Base64: {str(e)}")
-            show_error_dialog(f"Imagen Base64 inválida: {str(e)}")
-            return None
-
-    # Aplicar marca de agua
-    def apply_watermark(image: Image.Image, watermark: Image.Image, x: int, y: int) -> Image.Image:
-        if not watermark:
-            return image
-        img = image.copy()
-        watermark = watermark.copy()
-        if watermark.width > img.width or watermark.height > img.height:
-            watermark.thumbnail((img.width // 2, img.height // 2), Image.LANCZOS)
-        x = min(max(0, x), img.width - watermark.width)
-        y = min(max(0, y), img.height - watermark.height)
-        img.paste(watermark, (x, y), watermark if watermark.mode == "RGBA" else None)
-        return img
-
-    # Guardar vista previa
-    def save_preview(image: Image.Image) -> str:
-        temp_path = os.path.join(os.getcwd(), "temp_preview.png")
-        image.convert("RGB").save(temp_path, "PNG")
-        return temp_path
-
-    # Procesar imagen
-    def process_image(input_path: str, watermark: Image.Image, output_dir: str, x: int, y: int) -> bool:
-        image = load_image(input_path)
-        if not image:
-            return False
-        watermarked = apply_watermark(image, watermark, x, y)
-        rel_path = os.path.relpath(input_path, folder_path.value)
-        output_path = os.path.join(output_dir, rel_path)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Cargar en la sesión mostrando el error en pantalla
+    def load_preview(loader, source, label: str) -> bool:
         try:
-            watermarked.convert("RGB").save(output_path, "PNG")
-            logger.info(f"Imagen con marca de agua guardada: {output_path}")
+            loader(source)
             return True
         except Exception as e:
-            logger.error(f"No se pudo guardar {output_path}: {str(e)}")
+            logger.error(f"No se pudo cargar la imagen {label}: {str(e)}")
+            show_error_dialog(f"Error al cargar {label}: {str(e)}")
             return False
 
+    def show_preview(x: int, y: int):
+        preview_image.src_base64 = preview_session.render_base64(x, y)
+        preview_container.content = preview_image
+        page.update()
+
+    # Primera imagen compatible de la carpeta, recordada para no volver a recorrerla
+    def find_preview_source(folder: str):
+        cached = preview_sources.get(folder)
+        if cached and os.path.exists(cached):
+            return [cached]
+        return nucleo.iter_images(folder)
+
     # Generar vista previa
     def preview_watermark(e, base64_mode=False):
         if not folder_path.value and not base64_mode:
@@ -198,47 +153,104 @@ def main(page: ft.Page):
         except ValueError:
             show_snackbar("Coordenadas inválidas. Usa números.", ft.colors.RED_100)
             return
-        watermark = load_image(watermark_path.value)
-        if not watermark:
+        if not load_preview(preview_session.set_watermark, watermark_path.value, watermark_path.value):
             return
         if base64_mode:
             if not base64_input.value:
                 show_snackbar("Por favor, ingresa un string Base64.", ft.colors.RED_100)
                 return
-            image = load_base64_image(base64_input.value)
-            if not image:
+            try:
+                data = nucleo.decode_base64(base64_input.value)
+            except Exception as e:
+                logger.error(f"No se pudo decodificar la imagen Base64: {str(e)}")
+                show_error_dialog(f"Imagen Base64 inválida: {str(e)}")
                 return
-            watermarked = apply_watermark(image, watermark, x, y)
-            preview_path = save_preview(watermarked)
-            preview_container.content = ft.Image(
-                src=preview_path,
-                fit=ft.ImageFit.CONTAIN,
-                border_radius=8,
-                expand=True
-            )
+            if not load_preview(preview_session.set_image_bytes, data, "Base64"):
+                return
+            show_preview(x, y)
             show_snackbar("Vista previa de Base64 generada.", ft.colors.GREEN_100)
-            page.update()
             return
-        supported_extensions = (".png", ".jpg", ".jpeg", ".heic")
-        for root, _, files in os.walk(folder_path.value):
-            for file in files:
-                if file.lower().endswith(supported_extensions):
-                    image_path = os.path.join(root, file)
-                    image = load_image(image_path)
-                    if image:
-                        watermarked = apply_watermark(image, watermark, x, y)
-                        preview_path = save_preview(watermarked)
-                        preview_container.content = ft.Image(
-                            src=preview_path,
-                            fit=ft.ImageFit.CONTAIN,
-                            border_radius=8,
-                            expand=True
-                        )
-                        show_snackbar("Vista previa generada.", ft.colors.GREEN_100)
-                        page.update()
-                        return
+        for image_path in find_preview_source(folder_path.value):
+            if load_preview(preview_session.set_image, image_path, image_path):
+                preview_sources[folder_path.value] = image_path
+                show_preview(x, y)
+                show_snackbar("Vista previa generada.", ft.colors.GREEN_100)
+                return
         show_snackbar("No se encontraron imágenes compatibles para la vista previa.", ft.colors.RED_100)
 
+    # Al cambiar X/Y solo se recompone la vista previa ya cargada
+    def on_coords_change(e):
+        if not preview_session.ready:
+            return
+        try:
+            x = int(x_coord.value)
+            y = int(y_coord.value)
+        except ValueError:
+            return
+        show_preview(x, y)
+
+    x_coord.on_change = on_coords_change
+    y_coord.on_change = on_coords_change
+
+    # Formato H:MM:SS para el tiempo restante
+    def format_eta(seconds) -> str:
+        if seconds is None:
+            return "--:--"
+        minutes, secs = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+
+    # Mostrar el avance (el núcleo ya limita cuántas veces se llama)
+    def update_progress(progress: lote.Progress):
+        # Mientras se sigue buscando imágenes el total todavía puede crecer
+        progress_bar.value = progress.done / progress.total if progress.total and not progress.scanning else None
+        total = f"{progress.total}+" if progress.scanning else f"{progress.total}"
+        progress_text.value = (
+            f"{progress.done}/{total} · {progress.files_per_sec:.1f} img/s · "
+            f"quedan {format_eta(progress.eta)}"
+        )
+        page.update()
+
+    # Activar o desactivar los controles mientras hay un lote en marcha
+    def set_running(running: bool):
+        apply_button.disabled = running
+        cancel_button.disabled = not running
+        progress_bar.visible = running
+        if running:
+            progress_bar.value = None
+            progress_text.value = "Buscando imágenes..."
+        page.update()
+
+    # Cancelar el lote: termina lo que está en curso y conserva lo ya guardado
+    def cancel_batch(e):
+        cancel_event.set()
+        cancel_button.disabled = True
+        progress_text.value = "Cancelando..."
+        page.update()
+
+    # Ejecutar el lote fuera del hilo de la interfaz
+    def run_batch(x: int, y: int):
+        try:
+            result = lote.process_folder(
+                folder_path.value,
+                watermark_path.value,
+                output_path.value,
+                x,
+                y,
+                on_progress=update_progress,
+                cancel=cancel_event,
+            )
+        except Exception as e:
+            logger.error(f"No se pudo procesar el lote: {str(e)}")
+            set_running(False)
+            show_error_dialog(f"No se pudo procesar el lote: {str(e)}")
+            return
+        set_running(False)
+        message = f"Procesadas {result.processed} imágenes. Fallidas: {result.failed}."
+        if result.cancelled:
+            message = f"Cancelado. {message}"
+        show_snackbar(message, ft.colors.GREEN_100 if result.failed == 0 else ft.colors.RED_100)
+
     # Procesar carpeta
     def process_folder(e):
         if not all([folder_path.value, watermark_path.value, output_path.value]):
@@ -253,25 +265,23 @@ def main(page: ft.Page):
         except ValueError:
             show_snackbar("Coordenadas inválidas. Usa números.", ft.colors.RED_100)
             return
-        watermark = load_image(watermark_path.value)
-        if not watermark:
-            return
-        supported_extensions = (".png", ".jpg", ".jpeg", ".heic")
-        processed = 0
-        failed = 0
-        for root, _, files in os.walk(folder_path.value):
-            for file in files:
-                if file.lower().endswith(supported_extensions):
-                    input_path = os.path.join(root, file)
-                    if process_image(input_path, watermark, output_path.value, x, y):
-                        processed += 1
-                    else:
-                        failed += 1
-        show_snackbar(
-            f"Procesadas {processed} imágenes. Fallidas: {failed}.",
-            ft.colors.GREEN_100 if failed == 0 else ft.colors.RED_100,
-        )
-        logger.info(f"Procesadas {processed} imágenes. Fallidas: {failed}.")
+        cancel_event.clear()
+        set_running(True)
+        threading.Thread(target=run_batch, args=(x, y), daemon=True).start()
+
+    apply_button = ft.IconButton(
+        ft.icons.CHECK_CIRCLE,
+        on_click=process_folder,
+        tooltip="Aplicar Marca de Agua",
+        icon_color=ft.colors.GREEN_600,
+    )
+    cancel_button = ft.IconButton(
+        ft.icons.CANCEL,
+        on_click=cancel_batch,
+        tooltip="Cancelar",
+        icon_color=ft.colors.RED_600,
+        disabled=True,
+    )
 
     # Mostrar información
     def show_info_dialog(e):
@@ -284,6 +294,7 @@ def main(page: ft.Page):
                 "- 💾 Carpeta de Salida: Selecciona dónde guardar las imágenes procesadas.\n"
                 "- 👁️ Vista Previa: Muestra cómo quedará una imagen con la marca de agua.\n"
                 "- ✅ Aplicar Marca de Agua: Procesa todas las imágenes de la carpeta.\n"
+                "- ⛔ Cancelar: Detiene el lote en curso; lo ya guardado se conserva.\n"
                 "- 🖼️ Vista Previa Base64: Genera una vista previa de una imagen Base64 con la marca de agua."
             ),
             actions=[ft.TextButton("OK", on_click=lambda e: [setattr(page.dialog, "open", False), page.update()])],
@@ -418,12 +429,7 @@ def main(page: ft.Page):
                                                 col={"xs": 3, "sm": 2},
                                             ),
                                             ft.Container(
-                                                content=ft.IconButton(
-                                                    ft.icons.CHECK_CIRCLE,
-                                                    on_click=process_folder,
-                                                    tooltip="Aplicar Marca de Agua",
-                                                    icon_color=ft.colors.GREEN_600,
-                                                ),
+                                                content=apply_button,
                                                 col={"xs": 3, "sm": 2},
                                             ),
                                             ft.Container(
@@ -438,6 +444,14 @@ def main(page: ft.Page):
                                         ],
                                         alignment=ft.MainAxisAlignment.START,
                                     ),
+                                    ft.ResponsiveRow(
+                                        [
+                                            ft.Container(content=progress_bar, col={"xs": 12, "sm": 6}),
+                                            ft.Container(content=progress_text, col={"xs": 9, "sm": 4}),
+                                            ft.Container(content=cancel_button, col={"xs": 3, "sm": 2}),
+                                        ],
+                                        vertical_alignment=ft.CrossAxisAlignment.CENTER,
+                                    ),
                                     ft.Divider(),
                                     ft.Text("Vista Previa de Imagen Base64", size=16),
                                     ft.ResponsiveRow(
@@ -0,0 +1,98 @@
+import logging
+import os
+import sys
+import threading
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from marcasdeagua import formatos
+
+logger = logging.getLogger(__name__)
+
+# Bytes por píxel que ocupa cada modo en memoria dentro de Pillow
+_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+
+
+# Dimensiones y modo leyendo solo la cabecera, sin decodificar
+def image_header(file_path: str) -> Tuple[int, int, str]:
+    if formatos.is_heic(file_path):
+        import pyheif
+
+        heif_file = pyheif.open(file_path)
+        return heif_file.size[0], heif_file.size[1], heif_file.mode
+    with Image.open(file_path) as image:
+        return image.width, image.height, image.mode
+
+
+def estimate_footprint(file_path: str) -> int:
+    """Memoria aproximada que necesitará procesar el archivo, en bytes.
+
+    Cuenta la imagen decodificada (ancho x alto x bytes por píxel), una copia
+    más si hay que convertirla a RGB para componer, y los bytes comprimidos
+    que se leen del disco. Si la cabecera no se puede leer devuelve 0 y el
+    archivo fallará al cargarse como cualquier otro.
+    """
+    try:
+        width, height, mode = image_header(file_path)
+        compressed = os.path.getsize(file_path)
+    except Exception:
+        return 0
+    pixels = width * height
+    decoded = pixels * _BYTES_PER_PIXEL.get(mode, 4)
+    if mode not in ("RGB", "RGBA"):
+        decoded += pixels * 4
+    return decoded + compressed
+
+
+class MemoryBudget:
+    """Contador de memoria comprometida por las imágenes en curso.
+
+    Un trabajo entra si cabe en lo que queda del presupuesto o si no hay
+    nada más en curso; así una imagen mayor que todo el presupuesto se
+    procesa, pero en solitario.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def fits(self, cost: int) -> bool:
+        return self.in_use == 0 or self.in_use + cost <= self.limit
+
+    def take(self, cost: int) -> None:
+        with self._condition:
+            self.in_use += cost
+            self.peak = max(self.peak, self.in_use)
+
+    # Versión bloqueante, para productores que no recogen resultados ellos mismos
+    def acquire(self, cost: int) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self.fits(cost))
+            self.in_use += cost
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, cost: int) -> None:
+        with self._condition:
+            self.in_use -= cost
+            self._condition.notify_all()
+
+
+# Pico de memoria residente (proceso actual, o el mayor de los hijos ya terminados)
+def peak_rss(children: bool = False) -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        # Windows no tiene resource
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux lo da en KiB, macOS en bytes
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def format_bytes(size: Optional[int]) -> str:
+    if size is None:
+        return "desconocido"
+    return f"{size / (1 << 20):.0f} MB"
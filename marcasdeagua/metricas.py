@@ -0,0 +1,172 @@
+import json
+import math
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+# Etapas que se miden por archivo: "read", "decode", "watermark", "composite",
+# "encode" y "write". "decode" y "encode" llevan el formato detrás
+# ("decode:HEIC", "encode:PNG"); "watermark" es preparar la marca para ese
+# tamaño (remuestrear o rasterizar el SVG si no estaba en caché).
+class Timer:
+    """Duraciones por etapa de un archivo; cuesta un par de perf_counter por etapa."""
+
+    __slots__ = ("durations",)
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+# Cronómetro opcional: sin Timer las funciones no miden nada
+@contextmanager
+def stage(timer: Optional[Timer], name: str):
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+# Percentil por rango más cercano sobre una lista ya ordenada
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _split_stage(key: str):
+    stage, _, fmt = key.partition(":")
+    return stage, fmt
+
+
+class RunReport:
+    """Agrega las métricas de cada archivo en un informe del lote.
+
+    Da latencias por etapa (p50/p90/p99), bytes leídos y escritos, y
+    rendimiento por formato de entrada medido sobre el tiempo de trabajo de
+    sus archivos. Se exporta como JSON o en formato de texto de Prometheus.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.wall_seconds = 0.0
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+        self.formats: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"files": 0, "bytes_read": 0, "bytes_written": 0, "seconds": 0.0}
+        )
+        self.files = {"processed": 0, "failed": 0, "skipped": 0}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.extra: Dict[str, object] = {}
+        self._clock = time.perf_counter()
+
+    def add(self, result) -> None:
+        self.files["processed" if result.ok else "failed"] += 1
+        self.bytes_read += result.input_size
+        self.bytes_written += result.output_size
+        timings = result.timings or {}
+        for key, seconds in timings.items():
+            self.stages[key].append(seconds)
+        if result.input_format:
+            stats = self.formats[result.input_format]
+            stats["files"] += 1
+            stats["bytes_read"] += result.input_size
+            stats["bytes_written"] += result.output_size
+            stats["seconds"] += sum(timings.values())
+
+    def finish(self, skipped: int = 0, **extra) -> None:
+        self.wall_seconds = time.perf_counter() - self._clock
+        self.files["skipped"] = skipped
+        self.extra.update(extra)
+
+    def to_dict(self) -> dict:
+        stages = {}
+        for key in sorted(self.stages):
+            values = sorted(self.stages[key])
+            stages[key] = {
+                "count": len(values),
+                "total_seconds": sum(values),
+                "mean_seconds": sum(values) / len(values),
+                "max_seconds": values[-1],
+                **{f"p{round(q * 100)}_seconds": percentile(values, q) for q in QUANTILES},
+            }
+        formats = {}
+        for fmt, stats in sorted(self.formats.items()):
+            seconds = stats["seconds"]
+            formats[fmt] = {
+                **stats,
+                "files_per_busy_second": stats["files"] / seconds if seconds else 0.0,
+                "mb_read_per_busy_second": stats["bytes_read"] / (1 << 20) / seconds if seconds else 0.0,
+            }
+        done = self.files["processed"] + self.files["failed"]
+        return {
+            "started": self.started,
+            "wall_seconds": self.wall_seconds,
+            "files": dict(self.files),
+            "files_per_second": done / self.wall_seconds if self.wall_seconds else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "stages": stages,
+            "formats": formats,
+            **self.extra,
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_prometheus(self, prefix: str = "marcasdeagua") -> str:
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latencia por etapa y archivo.",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for key in sorted(self.stages):
+            values = sorted(self.stages[key])
+            stage, fmt = _split_stage(key)
+            labels = f'stage="{stage}",format="{fmt}"'
+            for q in QUANTILES:
+                lines.append(f'{prefix}_stage_seconds{{{labels},quantile="{q}"}} {percentile(values, q):.6f}')
+            lines.append(f"{prefix}_stage_seconds_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"{prefix}_stage_seconds_count{{{labels}}} {len(values)}")
+        lines += [f"# HELP {prefix}_files_total Archivos por resultado.", f"# TYPE {prefix}_files_total counter"]
+        for status, count in self.files.items():
+            lines.append(f'{prefix}_files_total{{status="{status}"}} {count}')
+        for name, value in (("read", self.bytes_read), ("written", self.bytes_written)):
+            lines += [f"# TYPE {prefix}_bytes_{name}_total counter", f"{prefix}_bytes_{name}_total {value}"]
+        lines += [f"# TYPE {prefix}_format_files_total counter"]
+        lines += [f'{prefix}_format_files_total{{format="{fmt}"}} {s["files"]}' for fmt, s in sorted(self.formats.items())]
+        lines += [f"# TYPE {prefix}_format_bytes_read_total counter"]
+        lines += [
+            f'{prefix}_format_bytes_read_total{{format="{fmt}"}} {s["bytes_read"]}' for fmt, s in sorted(self.formats.items())
+        ]
+        lines += [f"# TYPE {prefix}_format_busy_seconds_total counter"]
+        lines += [
+            f'{prefix}_format_busy_seconds_total{{format="{fmt}"}} {s["seconds"]:.6f}'
+            for fmt, s in sorted(self.formats.items())
+        ]
+        lines += [f"# TYPE {prefix}_run_wall_seconds gauge", f"{prefix}_run_wall_seconds {self.wall_seconds:.6f}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str, prefix: str = "marcasdeagua") -> None:
+        # Archivo temporal + rename para que node_exporter nunca lea uno a medias
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp_path, path)
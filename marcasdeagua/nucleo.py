@@ -0,0 +1,442 @@
+import os
+import io
+import base64
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Iterator, NamedTuple, Optional, Tuple, Union
+
+from PIL import Image, ImageChops, ImageOps
+
+from marcasdeagua import escaneo, formatos
+from marcasdeagua.formatos import EncodeOptions
+from marcasdeagua.cache import LRUCache
+from marcasdeagua.metricas import Timer, stage
+
+logger = logging.getLogger(__name__)
+
+
+# Resultado de procesar un archivo (viaja entre procesos, debe ser serializable)
+class FileResult(NamedTuple):
+    input_path: str
+    ok: bool
+    error: Optional[str] = None
+    cache_hits: int = 0
+    cache_misses: int = 0
+    output_path: Optional[str] = None
+    input_size: int = 0
+    input_mtime_ns: int = 0
+    input_hash: Optional[str] = None
+    # Métricas: segundos por etapa ("decode:JPEG", "encode:PNG"...), bytes escritos
+    timings: Optional[dict] = None
+    output_size: int = 0
+    input_format: Optional[str] = None
+
+
+# Formato de entrada para las métricas (HEIC y SVG no lo rellenan en Pillow)
+def source_format_name(image: Image.Image, file_path: str) -> str:
+    return image.format or os.path.splitext(file_path)[1].lstrip(".").upper() or "?"
+
+
+# Cargar imagen
+def load_image(
+    file_path: str, mode: Optional[str] = "RGBA", data: Optional[bytes] = None, timer: Optional[Timer] = None
+) -> Image.Image:
+    start = time.perf_counter()
+    image = formatos.open_image(file_path, data)
+    key = f"decode:{source_format_name(image, file_path)}"
+    if mode is None:
+        image.load()
+    else:
+        image = image.convert(mode)
+    if timer is not None:
+        timer.add(key, time.perf_counter() - start)
+    return image
+
+
+# Modos que pasan a RGB sin cambiar el resultado respecto a RGBA -> pegar -> RGB
+_RGB_COMPATIBLE_MODES = ("1", "L", "LA", "P", "PA", "CMYK", "YCbCr")
+
+# Modos cuyos valores ya son RGB: su perfil ICC sigue valiendo tras convertir
+_RGB_SPACE_MODES = ("RGB", "RGBA", "RGBX", "RGBa", "P", "PA")
+
+
+# Modo de trabajo para componer sin conversiones innecesarias
+def working_image(image: Image.Image) -> Image.Image:
+    """Imagen en RGB o RGBA y derecha, lista para pegar la marca.
+
+    Los píxeles se giran según la orientación EXIF (que pasa a 1), así la
+    marca queda derecha en (x, y) de la foto tal como se ve. Si la conversión
+    cambia el espacio de color (CMYK, grises...) se descarta el perfil ICC,
+    que ya no describe los píxeles.
+    """
+    if formatos.exif_orientation(image) != 1:
+        image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    converted = image.convert("RGB" if image.mode in _RGB_COMPATIBLE_MODES else "RGBA")
+    if image.mode not in _RGB_SPACE_MODES:
+        converted.info.pop("icc_profile", None)
+    return converted
+
+
+# Cargar imagen Base64 (admite data URIs)
+def load_base64_image(base64_str: str) -> Image.Image:
+    image = Image.open(io.BytesIO(decode_base64(base64_str)))
+    return image.convert("RGBA")
+
+
+def decode_base64(base64_str: str) -> bytes:
+    if base64_str.startswith("data:image"):
+        base64_str = base64_str.split(",")[1]
+    return base64.b64decode(base64_str)
+
+
+# Marca de agua preparada
+class Watermark:
+    """Marca de agua cargada una vez, con sus versiones reducidas en caché.
+
+    Cuando la marca no cabe en la imagen se reduce a la mitad del tamaño de
+    esta; cada tamaño distinto se remuestrea una sola vez y se guarda en una
+    LRU, en lugar de copiar y reducir la marca para cada foto.
+    """
+
+    def __init__(self, image: Image.Image, cache_size: int = 32):
+        self.image = image
+        self.cache = LRUCache(cache_size)
+
+    # Tamaño que tendrá la marca sobre una imagen de width x height
+    def target_size(self, width: int, height: int):
+        if self.image.width <= width and self.image.height <= height:
+            return self.image.size
+        return formatos.fit_size(self.image.size, (width // 2, height // 2))
+
+    # Versión a un tamaño arbitrario (vistas previas), sin pasar por la caché
+    def scaled(self, size) -> Image.Image:
+        return self.image.resize(size, Image.LANCZOS)
+
+    def for_size(self, width: int, height: int) -> Image.Image:
+        if self.image.width <= width and self.image.height <= height:
+            return self.image
+        bound = (width // 2, height // 2)
+        scaled = self.cache.get(bound)
+        if scaled is None:
+            scaled = self._resize(bound)
+            self.cache.put(bound, scaled)
+        return scaled
+
+    def _resize(self, bound) -> Image.Image:
+        scaled = self.image.copy()
+        scaled.thumbnail(bound, Image.LANCZOS)
+        return scaled
+
+
+# Marca de agua vectorial: se rasteriza al tamaño exacto en vez de reducir un bitmap
+class SvgWatermark(Watermark):
+    def __init__(self, file_path: str, cache_size: int = 32):
+        self.file_path = file_path
+        self.mtime_ns = formatos.svg_version(file_path)
+        super().__init__(self._render(formatos.svg_native_size(file_path, self.mtime_ns)), cache_size)
+
+    def _render(self, size) -> Image.Image:
+        return formatos.render_svg(self.file_path, self.mtime_ns, size).convert("RGBA")
+
+    def _resize(self, bound) -> Image.Image:
+        return self._render(formatos.fit_size(self.image.size, bound))
+
+    def scaled(self, size) -> Image.Image:
+        return self._render(size)
+
+
+# Parámetros del modo mosaico
+@dataclass(frozen=True)
+class TileOptions:
+    """Marca repetida sobre toda la imagen.
+
+    ``opacity`` (0-1) multiplica el alfa de la marca, ``size`` es el tamaño
+    máximo de cada marca como fracción del ancho y alto de la imagen,
+    ``spacing`` los píxeles libres entre marcas y ``angle`` los grados que se
+    gira el mosaico entero (en diagonal con el valor por defecto).
+    """
+
+    opacity: float = 0.3
+    size: float = 0.25
+    spacing: int = 100
+    angle: float = 30.0
+
+    def __post_init__(self):
+        if not 0 < self.opacity <= 1:
+            raise ValueError(f"La opacidad debe estar entre 0 y 1: {self.opacity}")
+        if not 0 < self.size <= 1:
+            raise ValueError(f"El tamaño debe estar entre 0 y 1: {self.size}")
+        if self.spacing < 0:
+            raise ValueError(f"El espaciado no puede ser negativo: {self.spacing}")
+
+
+# Marca en mosaico: una capa del tamaño de la imagen, calculada una vez por tamaño
+class TiledWatermark(Watermark):
+    """Mosaico girado y semitransparente de otra marca de agua.
+
+    ``for_size`` devuelve una capa RGBA del tamaño exacto de la imagen con la
+    opacidad ya aplicada al alfa, así que componer es un único ``paste`` con
+    máscara (en C) por foto. La baldosa se gira una vez y se pega en los
+    puntos de la red girada directamente sobre una capa del tamaño de la
+    imagen. Las capas ocupan una imagen completa cada una: la caché es
+    pequeña, pero siempre guarda al menos la última.
+    """
+
+    def __init__(self, base: Watermark, options: TileOptions, cache_size: int = 4):
+        super().__init__(base.image, cache_size)
+        self.base = base
+        self.options = options
+
+    def target_size(self, width: int, height: int):
+        return width, height
+
+    def scaled(self, size) -> Image.Image:
+        return self._layer(*size)
+
+    def for_size(self, width: int, height: int) -> Image.Image:
+        layer = self.cache.get((width, height))
+        if layer is None:
+            layer = self._layer(width, height)
+            self.cache.put((width, height), layer)
+        return layer
+
+    # Una marca con la opacidad aplicada y su hueco alrededor
+    def _tile(self, width: int, height: int) -> Image.Image:
+        options = self.options
+        bound = (max(1, int(width * options.size)), max(1, int(height * options.size)))
+        mark = self.base.image
+        if mark.width > bound[0] or mark.height > bound[1]:
+            mark = self.base._resize(bound)
+        mark = mark.convert("RGBA")
+        if options.opacity < 1:
+            alpha = mark.getchannel("A").point(lambda a: round(a * options.opacity))
+            mark.putalpha(alpha)
+        tile = Image.new("RGBA", (mark.width + options.spacing, mark.height + options.spacing), (0, 0, 0, 0))
+        tile.paste(mark, (options.spacing // 2, options.spacing // 2))
+        return tile
+
+    def _layer(self, width: int, height: int) -> Image.Image:
+        tile = self._tile(width, height)
+        # Alfa premultiplicado: el filtro no oscurece los bordes y los bordes
+        # suavizados de baldosas vecinas se suman sin dejar costuras
+        tile = tile.convert("RGBa")
+        theta = math.radians(self.options.angle)
+        # Pasos de la red girada, redondeados a píxeles enteros: todas las
+        # baldosas son la misma imagen pegada en posiciones exactas
+        step_x = (round(tile.width * math.cos(theta)), round(-tile.width * math.sin(theta)))
+        step_y = (round(tile.height * math.sin(theta)), round(tile.height * math.cos(theta)))
+        if step_x == (tile.width, 0) and step_y == (0, tile.height):
+            mark = tile
+        else:
+            # Se transforma una sola baldosa (un giro, ajustado a esos pasos
+            # en menos de medio píxel), no un lienzo del tamaño de la diagonal
+            size = (abs(step_x[0]) + abs(step_y[0]) + 6, abs(step_x[1]) + abs(step_y[1]) + 6)
+            det = step_x[0] * step_y[1] - step_y[0] * step_x[1]
+            a, b = step_y[1] * tile.width / det, -step_y[0] * tile.width / det
+            d, e = -step_x[1] * tile.height / det, step_x[0] * tile.height / det
+            cx, cy = size[0] // 2, size[1] // 2
+            # Borde transparente: ``transform`` deja a cero lo que cae fuera de
+            # la imagen en lugar de filtrarlo, y cortaría los bordes en seco
+            padded = Image.new("RGBa", (tile.width + 4, tile.height + 4), (0, 0, 0, 0))
+            padded.paste(tile, (2, 2))
+            mark = padded.transform(
+                size,
+                Image.AFFINE,
+                (a, b, padded.width / 2 - a * cx - b * cy, d, e, padded.height / 2 - d * cx - e * cy),
+                # Bilineal: sin lóbulos negativos, los bordes de baldosas vecinas suman justo 1
+                Image.BILINEAR,
+            )
+        reach = (math.hypot(width, height) + math.hypot(mark.width, mark.height)) / 2
+        columns = math.ceil(reach / tile.width)
+        rows = math.ceil(reach / tile.height)
+        layer = Image.new("RGBa", (width, height), (0, 0, 0, 0))
+        for i in range(-columns, columns + 1):
+            for j in range(-rows, rows + 1):
+                # Baldosa centrada en este punto de la red (la central, en el centro de la imagen)
+                left = width // 2 + i * step_x[0] + j * step_y[0] - mark.width // 2
+                top = height // 2 + i * step_x[1] + j * step_y[1] - mark.height // 2
+                box = (max(left, 0), max(top, 0), min(left + mark.width, width), min(top + mark.height, height))
+                if box[0] >= box[2] or box[1] >= box[3]:
+                    continue
+                piece = mark.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+                layer.paste(ImageChops.add(layer.crop(box), piece), box)
+        return layer.convert("RGBA")
+
+
+# Cargar marca de agua
+def load_watermark(file_path: str, cache_size: int = 32, tile: Optional[TileOptions] = None) -> Watermark:
+    if os.path.splitext(file_path)[1].lower() == ".svg":
+        watermark = SvgWatermark(file_path, cache_size)
+    else:
+        watermark = Watermark(load_image(file_path), cache_size)
+    if tile is not None:
+        return TiledWatermark(watermark, tile, max(1, min(cache_size, 4)))
+    return watermark
+
+
+# Aplicar marca de agua
+def apply_watermark(
+    image: Image.Image,
+    watermark: Union[Watermark, Image.Image],
+    x: int,
+    y: int,
+    in_place: bool = False,
+    timer: Optional[Timer] = None,
+) -> Image.Image:
+    """Pega la marca de agua en (x, y), ajustada para que quede dentro.
+
+    La mezcla alfa solo toca el rectángulo de la marca. Con ``in_place`` se
+    escribe directamente sobre ``image`` (en RGB o RGBA, ver
+    ``working_image``) en lugar de trabajar sobre una copia. Con ``timer``
+    se mide la preparación de la marca ("watermark") y el pegado ("composite").
+    """
+    if not watermark:
+        return image
+    if not isinstance(watermark, Watermark):
+        watermark = Watermark(watermark, cache_size=0)
+    img = image if in_place else image.copy()
+    with stage(timer, "watermark"):
+        watermark = watermark.for_size(img.width, img.height)
+    with stage(timer, "composite"):
+        x = min(max(0, x), img.width - watermark.width)
+        y = min(max(0, y), img.height - watermark.height)
+        img.paste(watermark, (x, y), watermark if watermark.mode == "RGBA" else None)
+    return img
+
+
+# Imagen ya compuesta, lista para codificar
+class Composed(NamedTuple):
+    image: Image.Image
+    fmt: str
+    output_path: str
+    input_format: Optional[str] = None
+    timer: Optional[Timer] = None
+
+
+# Etapa 1: decodificar y componer. Si falla devuelve el FileResult del error
+def compose_image(
+    input_path: str,
+    watermark: Union[Watermark, Image.Image],
+    input_dir: str,
+    output_dir: str,
+    x: int,
+    y: int,
+    encode: EncodeOptions,
+    data: Optional[bytes] = None,
+    timer: Optional[Timer] = None,
+) -> Union[Composed, FileResult]:
+    timer = timer or Timer()
+    try:
+        image = load_image(input_path, mode=None, data=data, timer=timer)
+        source_format = image.format
+        input_format = source_format_name(image, input_path)
+        with timer.stage("composite"):
+            image = working_image(image)
+    except Exception as e:
+        logger.error("No se pudo cargar la imagen %s: %s", input_path, e)
+        return FileResult(input_path, False, f"Error al cargar: {str(e)}", timings=timer.durations)
+    watermarked = apply_watermark(image, watermark, x, y, in_place=True, timer=timer)
+    if watermarked.mode != "RGB":
+        with timer.stage("composite"):
+            watermarked = watermarked.convert("RGB")
+    fmt = encode.output_format(source_format)
+    rel_path = formatos.output_name(os.path.relpath(input_path, input_dir), fmt)
+    return Composed(watermarked, fmt, os.path.join(output_dir, rel_path), input_format, timer)
+
+
+# Codificar en memoria
+def encode_image(image: Image.Image, fmt: str, encode: EncodeOptions, timer: Optional[Timer] = None) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with stage(timer, f"encode:{fmt}"):
+        image.save(buffer, fmt, **encode.save_params(fmt, image.info))
+    return buffer
+
+
+# Escribimos a un temporal y renombramos: nunca queda una salida a medias
+def write_file(output_path: str, data) -> None:
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = output_path + ".part"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Etapa 2: codificar y escribir
+def save_image(input_path: str, composed: Composed, encode: EncodeOptions) -> FileResult:
+    image, fmt, output_path, input_format, timer = composed
+    timer = timer or Timer()
+    try:
+        # Codificamos en memoria para medir por separado la codificación y el disco
+        buffer = encode_image(image, fmt, encode, timer)
+        with timer.stage("write"):
+            write_file(output_path, buffer.getbuffer())
+        logger.info("Imagen con marca de agua guardada: %s", output_path)
+        return FileResult(
+            input_path,
+            True,
+            output_path=output_path,
+            timings=timer.durations,
+            output_size=buffer.getbuffer().nbytes,
+            input_format=input_format,
+        )
+    except Exception as e:
+        logger.error("No se pudo guardar %s: %s", output_path, e)
+        return FileResult(
+            input_path, False, f"Error al guardar: {str(e)}", timings=timer.durations, input_format=input_format
+        )
+
+
+# Procesar imagen
+def process_image(
+    input_path: str,
+    watermark: Union[Watermark, Image.Image],
+    input_dir: str,
+    output_dir: str,
+    x: int,
+    y: int,
+    encode: Optional[EncodeOptions] = None,
+    data: Optional[bytes] = None,
+    timer: Optional[Timer] = None,
+) -> FileResult:
+    encode = encode or EncodeOptions()
+    composed = compose_image(input_path, watermark, input_dir, output_dir, x, y, encode, data, timer)
+    if isinstance(composed, FileResult):
+        return composed
+    return save_image(input_path, composed, encode)
+
+
+# Procesar una imagen que ya está en memoria (subidas al servicio HTTP).
+# Devuelve los bytes codificados y su formato; los errores se propagan.
+def watermark_bytes(
+    data: bytes,
+    watermark: Union[Watermark, Image.Image],
+    x: int,
+    y: int,
+    encode: Optional[EncodeOptions] = None,
+    name: str = "",
+    timer: Optional[Timer] = None,
+) -> Tuple[bytes, str]:
+    encode = encode or EncodeOptions()
+    image = load_image(name, mode=None, data=data, timer=timer)
+    source_format = image.format
+    with stage(timer, "composite"):
+        image = working_image(image)
+    image = apply_watermark(image, watermark, x, y, in_place=True, timer=timer)
+    if image.mode != "RGB":
+        with stage(timer, "composite"):
+            image = image.convert("RGB")
+    fmt = encode.output_format(source_format)
+    return encode_image(image, fmt, encode, timer).getvalue(), fmt
+
+
+# Buscar imágenes compatibles
+def iter_images(input_dir: str) -> Iterator[str]:
+    return escaneo.scan_images(input_dir)
@@ -0,0 +1,305 @@
+import base64
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from PIL import UnidentifiedImageError
+
+from marcasdeagua.formatos import EncodeOptions
+from marcasdeagua.nucleo import decode_base64, load_watermark, watermark_bytes
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Errores que se deben a la imagen recibida, no al servicio
+_CLIENT_ERRORS = (UnidentifiedImageError, ValueError, SyntaxError, EOFError, OSError)
+
+
+class RequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# Estado de cada proceso de trabajo: las marcas se cargan y preparan una vez
+_worker_watermarks = {}
+
+
+def _init_worker(watermarks: Dict[str, str], cache_size: int) -> None:
+    for name, path in watermarks.items():
+        _worker_watermarks[name] = load_watermark(path, cache_size)
+
+
+def _render_task(data: bytes, watermark: str, x: int, y: int, encode: EncodeOptions) -> Tuple[bytes, str]:
+    return watermark_bytes(data, _worker_watermarks[watermark], x, y, encode)
+
+
+# Opciones de una petición (query string, campos multipart o una línea JSON)
+def _options(params: dict, default_watermark: str, watermarks: Dict[str, str]) -> Tuple[str, int, int, EncodeOptions]:
+    name = params.get("watermark") or default_watermark
+    if not isinstance(name, str):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "El nombre de la marca de agua debe ser texto")
+    if name not in watermarks:
+        raise RequestError(HTTPStatus.NOT_FOUND, f"Marca de agua desconocida: {name}")
+    try:
+        x = int(params.get("x", 10))
+        y = int(params.get("y", 10))
+        encode = EncodeOptions(format=params.get("format", "original"), quality=int(params.get("quality", 90)))
+    except (TypeError, ValueError, AttributeError) as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"Parámetros inválidos: {e}")
+    return name, x, y, encode
+
+
+def _decode_text(text: str) -> bytes:
+    if not isinstance(text, str):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "La imagen debe ir como texto base64")
+    try:
+        return decode_base64(text.strip())
+    except (ValueError, IndexError) as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"Base64 inválido: {e}")
+
+
+# Imagen y campos de un cuerpo multipart/form-data
+def _parse_multipart(content_type: str, body: bytes) -> Tuple[bytes, dict]:
+    message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Cuerpo multipart inválido")
+    image, fields = None, {}
+    for part in message.iter_parts():
+        payload = part.get_payload(decode=True) or b""
+        if part.get_filename() or part.get_param("name", header="content-disposition") == "image":
+            if image is None:
+                image = payload
+        else:
+            fields[part.get_param("name", header="content-disposition")] = payload.decode("utf-8", "replace")
+    if image is None:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "No hay ninguna imagen en el formulario")
+    return image, fields
+
+
+class WatermarkService:
+    """Servicio HTTP local que pone marcas de agua a imágenes recibidas.
+
+    Las marcas se cargan y preparan una vez en cada proceso del pool; cada
+    petición solo decodifica la imagen, compone y codifica en memoria. Acepta
+    bytes en crudo, multipart/form-data, base64 o data URI, y JSON lines en
+    ``/batch``. Las conexiones se mantienen abiertas (HTTP/1.1 keep-alive).
+    """
+
+    def __init__(
+        self,
+        watermarks: Dict[str, str],
+        workers: Optional[int] = None,
+        watermark_cache_size: int = 32,
+        max_body: int = 64 << 20,
+    ):
+        if not watermarks:
+            raise ValueError("Hace falta al menos una marca de agua")
+        # Validamos las marcas aquí para fallar antes de lanzar procesos
+        for path in watermarks.values():
+            load_watermark(path, cache_size=0)
+        self.watermarks = dict(watermarks)
+        self.default_watermark = next(iter(self.watermarks))
+        self.workers = workers or os.cpu_count() or 1
+        self.max_body = max_body
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self.watermarks, watermark_cache_size)
+        )
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self.httpd: Optional[ThreadingHTTPServer] = None
+
+    def render(self, data: bytes, params: dict) -> Tuple[bytes, str]:
+        name, x, y, encode = _options(params, self.default_watermark, self.watermarks)
+        try:
+            return self.executor.submit(_render_task, data, name, x, y, encode).result()
+        except _CLIENT_ERRORS as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"No se pudo procesar la imagen: {e}")
+
+    # Una línea de /batch: se lanza ya y se espera al responder, para solaparlas
+    def submit_line(self, line: bytes, defaults: dict):
+        item = json.loads(line)
+        if not isinstance(item, dict):
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Cada línea debe ser un objeto JSON")
+        item = {**defaults, **item}
+        name, x, y, encode = _options(item, self.default_watermark, self.watermarks)
+        data = _decode_text(item.get("image") or "")
+        return item.get("id"), self.executor.submit(_render_task, data, name, x, y, encode)
+
+    def count(self, ok: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            if not ok:
+                self.failures += 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "workers": self.workers,
+            "watermarks": list(self.watermarks),
+        }
+
+    def serve_forever(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+        logger.info("Servicio escuchando en http://%s:%s", *self.httpd.server_address[:2])
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self.httpd:
+            self.httpd.server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "marcasdeagua"
+
+    @property
+    def service(self) -> WatermarkService:
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/health":
+            self._send_json(HTTPStatus.OK, self.service.stats())
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, "Ruta desconocida")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            body = self._read_body()
+            if url.path == "/watermark":
+                self._watermark(body, dict(parse_qsl(url.query)))
+            elif url.path == "/batch":
+                self._batch(body, dict(parse_qsl(url.query)))
+            else:
+                raise RequestError(HTTPStatus.NOT_FOUND, "Ruta desconocida")
+        except RequestError as e:
+            self.service.count(False)
+            self._send_error(e.status, str(e))
+        except Exception as e:
+            logger.exception("Error inesperado en %s", self.path)
+            self.service.count(False)
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+    def _read_body(self) -> bytes:
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, "Falta Content-Length")
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Sin una longitud válida no sabemos dónde acaba el cuerpo
+            self.close_connection = True
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Content-Length inválido")
+        if length > self.service.max_body:
+            # No leemos el cuerpo: la conexión no se puede reutilizar
+            self.close_connection = True
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Cuerpo demasiado grande")
+        return self.rfile.read(length)
+
+    def _watermark(self, body: bytes, params: dict) -> None:
+        content_type = self.headers.get("Content-Type", "")
+        media_type = content_type.split(";")[0].strip().lower()
+        if media_type == "multipart/form-data":
+            data, fields = _parse_multipart(content_type, body)
+            params = {**fields, **params}
+        elif media_type == "application/json":
+            try:
+                item = json.loads(body)
+            except ValueError as e:
+                raise RequestError(HTTPStatus.BAD_REQUEST, f"JSON inválido: {e}")
+            if not isinstance(item, dict):
+                raise RequestError(HTTPStatus.BAD_REQUEST, "El cuerpo debe ser un objeto JSON")
+            params = {**{k: v for k, v in item.items() if k != "image"}, **params}
+            data = _decode_text(item.get("image") or "")
+        elif media_type in ("text/plain", "application/base64") or body[:5] == b"data:":
+            data = _decode_text(body.decode("ascii", "replace"))
+        else:
+            data = body
+        result, fmt = self.service.render(data, params)
+        self.service.count(True)
+        if params.get("output") == "base64":
+            encoded = base64.b64encode(result).decode("ascii")
+            self._send(HTTPStatus.OK, f"data:{CONTENT_TYPES[fmt]};base64,{encoded}".encode("ascii"), "text/plain")
+        else:
+            self._send(HTTPStatus.OK, result, CONTENT_TYPES[fmt])
+
+    def _batch(self, body: bytes, params: dict) -> None:
+        """Una imagen por línea JSON; la respuesta sale en el mismo orden, línea a línea.
+
+        Los parámetros de la URL valen para las líneas que no los traen.
+        """
+        jobs = []
+        for number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append(self.service.submit_line(line, params))
+            except Exception as e:
+                # Una línea mala no tumba las demás, que ya están en marcha
+                if not isinstance(e, (ValueError, RequestError)):
+                    logger.exception("Error inesperado en la línea %d de /batch", number)
+                jobs.append((number, e))
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for job_id, job in jobs:
+            try:
+                if isinstance(job, Exception):
+                    raise job
+                result, fmt = job.result()
+                line = {"id": job_id, "ok": True, "format": fmt, "image": base64.b64encode(result).decode("ascii")}
+            except Exception as e:
+                # Las cabeceras ya salieron: cualquier fallo va en su línea
+                if not isinstance(e, _CLIENT_ERRORS + (RequestError,)):
+                    logger.exception("Error inesperado en /batch")
+                line = {"id": job_id, "ok": False, "error": str(e)}
+            self.service.count(line["ok"])
+            chunk = json.dumps(line).encode("utf-8") + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: HTTPStatus, data: dict) -> None:
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def _send_error(self, status: HTTPStatus, message: str) -> None:
+        self._send_json(status, {"error": message})
+
+
+# "nombre=ruta" o solo "ruta" (el nombre es el del archivo sin extensión)
+def parse_watermark_spec(spec: str) -> Tuple[str, str]:
+    name, sep, path = spec.partition("=")
+    if not sep:
+        path = spec
+        name = os.path.splitext(os.path.basename(spec))[0]
+    return name, path
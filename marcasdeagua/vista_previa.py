@@ -0,0 +1,90 @@
+import base64
+import io
+import os
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from marcasdeagua import formatos, nucleo
+
+
+class PreviewSession:
+    """Vista previa interactiva que solo recompone al mover la marca.
+
+    Guarda una versión reducida de la imagen base (con decodificación
+    reducida de JPEG cuando se puede) y la marca de agua ya escalada a esa
+    vista. Cambiar X/Y solo vuelve a pegar la marca sobre la base pequeña y
+    devuelve el resultado en base64, sin tocar el disco.
+    """
+
+    def __init__(self, max_size: Tuple[int, int] = (1280, 960)):
+        self.max_size = max_size
+        self.base: Optional[Image.Image] = None
+        self.full_size: Tuple[int, int] = (0, 0)
+        self.watermark: Optional[nucleo.Watermark] = None
+        self._base_key = None
+        self._watermark_key = None
+        self._scaled = None
+        self._scaled_key = None
+
+    @property
+    def ready(self) -> bool:
+        return self.base is not None and self.watermark is not None
+
+    def set_image(self, file_path: str) -> None:
+        key = (file_path, os.stat(file_path).st_mtime_ns)
+        if key != self._base_key:
+            self._set_base(formatos.open_image(file_path))
+            self._base_key = key
+
+    def set_image_bytes(self, data: bytes) -> None:
+        key = hash(data)
+        if key != self._base_key:
+            self._set_base(Image.open(io.BytesIO(data)))
+            self._base_key = key
+
+    def set_watermark(self, file_path: str) -> None:
+        key = (file_path, os.stat(file_path).st_mtime_ns)
+        if key != self._watermark_key:
+            self.watermark = nucleo.load_watermark(file_path, cache_size=0)
+            self._watermark_key = key
+            self._scaled = None
+
+    def _set_base(self, image: Image.Image) -> None:
+        # Tamaño de la foto tal como se verá, ya girada según su EXIF
+        width, height = image.size
+        self.full_size = (height, width) if formatos.exif_orientation(image) in (5, 6, 7, 8) else (width, height)
+        image = formatos.draft(image, self.max_size)
+        image = nucleo.working_image(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail(self.max_size, Image.BILINEAR)
+        self.base = image
+        self._scaled = None
+
+    # Marca de agua al tamaño que tendrá en la vista previa
+    def _preview_watermark(self) -> Image.Image:
+        scale = self.base.width / self.full_size[0]
+        width, height = self.watermark.target_size(*self.full_size)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if self._scaled_key != size or self._scaled is None:
+            self._scaled = self.watermark.scaled(size)
+            self._scaled_key = size
+        return self._scaled
+
+    def render(self, x: int, y: int) -> Image.Image:
+        full_width, full_height = self.full_size
+        width, height = self.watermark.target_size(full_width, full_height)
+        # Mismo ajuste que apply_watermark, calculado a resolución completa
+        x = min(max(0, x), full_width - width)
+        y = min(max(0, y), full_height - height)
+        scale = self.base.width / full_width
+        watermark = self._preview_watermark()
+        image = self.base.copy()
+        image.paste(watermark, (round(x * scale), round(y * scale)), watermark if watermark.mode == "RGBA" else None)
+        return image
+
+    def render_base64(self, x: int, y: int) -> str:
+        buffer = io.BytesIO()
+        self.render(x, y).save(buffer, "JPEG", quality=85)
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
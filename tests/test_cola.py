@@ -0,0 +1,88 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from PIL import Image
+
+from marcasdeagua import cola
+
+
+@pytest.fixture
+def job(tmp_path):
+    input_dir = tmp_path / "entrada"
+    (input_dir / "sub").mkdir(parents=True)
+    for i in range(12):
+        folder = input_dir / "sub" if i % 3 == 0 else input_dir
+        Image.new("RGB", (64, 48), (i * 20, 0, 0)).save(folder / f"foto_{i:02d}.jpg")
+    watermark = tmp_path / "marca.png"
+    Image.new("RGBA", (16, 16), (255, 255, 255, 128)).save(watermark)
+    return {
+        "db_path": str(tmp_path / "cola.sqlite"),
+        "input_dir": str(input_dir),
+        "watermark_path": str(watermark),
+        "output_dir": str(tmp_path / "salida"),
+        "x": 5,
+        "y": 5,
+    }
+
+
+def _outputs(output_dir):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), output_dir)
+        for root, _, names in os.walk(output_dir)
+        for name in names
+    )
+
+
+def test_varios_procesos_vacian_la_cola(job):
+    assert cola.enqueue(**job) == 12
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(cola.work, job["db_path"], None, batch_size=2, poll_interval=0.05) for _ in range(3)
+        ]
+        results = [future.result() for future in futures]
+    assert sum(done for done, _ in results) == 12
+    assert sum(failed for _, failed in results) == 0
+    with cola.WorkQueue(job["db_path"]) as queue:
+        assert queue.counts()["done"] == 12
+    assert len(_outputs(job["output_dir"])) == 12
+
+
+def test_arrendamiento_vencido_se_reclama(job):
+    cola.enqueue(**job)
+    with cola.WorkQueue(job["db_path"]) as queue:
+        # Un trabajador reclama y "muere" sin terminar
+        stale = queue.claim("muerto", 5, lease=0.05)
+        assert len(stale) == 5
+    time.sleep(0.1)
+    processed, failed = cola.work(job["db_path"], "vivo", batch_size=4, poll_interval=0.05)
+    assert (processed, failed) == (12, 0)
+    with cola.WorkQueue(job["db_path"]) as queue:
+        counts = queue.counts()
+        assert counts["done"] == 12 and counts["leased"] == 0
+        # El muerto ya no puede cerrar lo que reclamó
+        assert not queue.finish("muerto", stale[0][0], True)
+
+
+def test_demasiados_intentos_pasa_a_fallida(job):
+    cola.enqueue(**job)
+    with cola.WorkQueue(job["db_path"], max_attempts=2) as queue:
+        for _ in range(2):
+            assert queue.claim("inestable", 1, lease=0.01)
+            time.sleep(0.05)
+        # El siguiente reparto da la ruta por perdida en lugar de entregarla otra vez
+        claimed = queue.claim("otro", 1, lease=60)
+        counts = queue.counts()
+        failures = queue.failures()
+    assert claimed and claimed[0][1] != failures[0][0]
+    assert counts["failed"] == 1
+    assert failures[0][1] == "Demasiados intentos"
+
+
+def test_enqueue_rechaza_otros_parametros(job):
+    cola.enqueue(**job)
+    # Repetir con los mismos parámetros solo añade lo nuevo
+    assert cola.enqueue(**job) == 0
+    with pytest.raises(ValueError):
+        cola.enqueue(**{**job, "x": 50})
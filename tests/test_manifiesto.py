@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from marcasdeagua.manifiesto import Manifest, file_digest
+
+
+@pytest.fixture
+def tree(tmp_path):
+    input_dir = tmp_path / "entrada"
+    output_dir = tmp_path / "salida"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for name in ("a.jpg", "b.jpg"):
+        (input_dir / name).write_bytes(b"contenido " + name.encode())
+    return str(input_dir), str(output_dir)
+
+
+# Manifiesto con todas las entradas ya procesadas (y sus salidas en disco)
+def _processed(input_dir, output_dir, fingerprint="huella"):
+    manifest = Manifest(output_dir, fingerprint)
+    for name in sorted(os.listdir(input_dir)):
+        input_path = os.path.join(input_dir, name)
+        st = os.stat(input_path)
+        open(os.path.join(output_dir, name), "wb").close()
+        manifest.record(name, st.st_size, st.st_mtime_ns, file_digest(input_path), name)
+    manifest.save()
+    return manifest
+
+
+def _paths(input_dir):
+    return [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))]
+
+
+def _pending(manifest, input_dir):
+    skipped = []
+    pending = list(manifest.pending(_paths(input_dir), input_dir, on_skip=skipped.append))
+    return [os.path.basename(p) for p in pending], [os.path.basename(p) for p in skipped]
+
+
+def test_todo_nuevo_sin_manifiesto(tree):
+    input_dir, output_dir = tree
+    assert _pending(Manifest.load(output_dir, "huella"), input_dir) == (["a.jpg", "b.jpg"], [])
+
+
+def test_sin_cambios_se_salta(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    assert _pending(Manifest.load(output_dir, "huella"), input_dir) == ([], ["a.jpg", "b.jpg"])
+
+
+def test_otra_huella_invalida_todo(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    assert _pending(Manifest.load(output_dir, "otra"), input_dir) == (["a.jpg", "b.jpg"], [])
+
+
+def test_salida_borrada_se_rehace(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    os.remove(os.path.join(output_dir, "a.jpg"))
+    assert _pending(Manifest.load(output_dir, "huella"), input_dir) == (["a.jpg"], ["b.jpg"])
+
+
+def test_otro_tamano_se_rehace(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    with open(os.path.join(input_dir, "a.jpg"), "ab") as f:
+        f.write(b"mas")
+    assert _pending(Manifest.load(output_dir, "huella"), input_dir) == (["a.jpg"], ["b.jpg"])
+
+
+def test_solo_mtime_decide_el_hash(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    a, b = (os.path.join(input_dir, name) for name in ("a.jpg", "b.jpg"))
+    # a: mismo contenido con otra fecha; b: mismo tamaño con otro contenido
+    os.utime(a, ns=(0, 10**18))
+    with open(b, "r+b") as f:
+        f.write(b"C")
+    os.utime(b, ns=(0, 10**18))
+    manifest = Manifest.load(output_dir, "huella")
+    assert _pending(manifest, input_dir) == (["b.jpg"], ["a.jpg"])
+    # El nuevo mtime de a queda anotado para no volver a leerlo
+    assert manifest.files["a.jpg"]["mtime_ns"] == 10**18
+
+
+def test_entradas_borradas_se_olvidan(tree):
+    input_dir, output_dir = tree
+    _processed(input_dir, output_dir)
+    os.remove(os.path.join(input_dir, "b.jpg"))
+    manifest = Manifest.load(output_dir, "huella")
+    _pending(manifest, input_dir)
+    manifest.save()
+    assert set(Manifest.load(output_dir, "huella").files) == {"a.jpg"}
+
+
+def test_manifiesto_ilegible_procesa_todo(tree):
+    input_dir, output_dir = tree
+    manifest = _processed(input_dir, output_dir)
+    with open(manifest.path, "w") as f:
+        f.write("{roto")
+    assert _pending(Manifest.load(output_dir, "huella"), input_dir) == (["a.jpg", "b.jpg"], [])
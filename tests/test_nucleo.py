@@ -0,0 +1,52 @@
+import pytest
+from PIL import Image
+
+from marcasdeagua import nucleo
+
+
+def _source(mode: str) -> Image.Image:
+    rgb = Image.merge(
+        "RGB",
+        (
+            Image.linear_gradient("L").resize((256, 192)),
+            Image.linear_gradient("L").rotate(90).resize((256, 192)),
+            Image.radial_gradient("L").resize((256, 192)),
+        ),
+    )
+    alpha = Image.radial_gradient("L").resize((256, 192))
+    if mode == "RGBA":
+        return Image.merge("RGBA", (*rgb.split(), alpha))
+    if mode == "LA":
+        return Image.merge("LA", (rgb.convert("L"), alpha))
+    if mode == "P":
+        return rgb.quantize(64)
+    if mode == "I;16":
+        return rgb.convert("L").point(lambda v: v * 257, "I").convert("I;16")
+    return rgb.convert(mode)
+
+
+def _watermark() -> Image.Image:
+    color = Image.linear_gradient("L").resize((48, 32))
+    alpha = Image.radial_gradient("L").resize((48, 32))
+    return Image.merge("RGBA", (color, color.rotate(180), color.transpose(Image.FLIP_LEFT_RIGHT), alpha))
+
+
+# Camino anterior: todo a RGBA, pegar sobre una copia y pasar a RGB
+def _reference(image: Image.Image, watermark: Image.Image, x: int, y: int) -> Image.Image:
+    img = image.convert("RGBA")
+    x = min(max(0, x), img.width - watermark.width)
+    y = min(max(0, y), img.height - watermark.height)
+    img.paste(watermark, (x, y), watermark)
+    return img.convert("RGB")
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA", "P", "CMYK", "I;16"])
+@pytest.mark.parametrize("position", [(10, 10), (230, 180), (-5, 400)])
+def test_composicion_en_su_modo_igual_que_en_rgba(mode, position):
+    image = _source(mode)
+    watermark = _watermark()
+    expected = _reference(image, watermark, *position)
+    result = nucleo.apply_watermark(nucleo.working_image(image), nucleo.Watermark(watermark), *position, in_place=True)
+    if result.mode != "RGB":
+        result = result.convert("RGB")
+    assert result.tobytes() == expected.tobytes()